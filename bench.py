@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+
+"""
+Cluster performance benchmarks, run by `mars bench`.
+
+Each benchmark is a subcommand of this script, which is copied to every node and
+prints its results as JSON on stdout. run_suite drives the benchmarks over a runner,
+which starts them either on the cluster's nodes over SSH or as local processes on
+127.0.0.1, standing in for nodes when testing.
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import shlex
+import socket
+import socketserver
+import statistics
+import struct
+import subprocess as sp
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_SCRIPT  = os.path.abspath(__file__)
+REMOTE_SCRIPT = "/tmp/mars_bench.py"
+SIZE_UNITS    = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+# Parse a size such as 64MB, 1.5G or 4096 into bytes
+def parse_size(size):
+    match = re.fullmatch(r"(\d+\.?\d*|\.\d+)\s*(?:([KMGT])I?)?B?", str(size).strip(), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size {size!r}, expected bytes or a number with a unit such as 64MB or 1.5G")
+    return int(float(match.group(1)) * SIZE_UNITS[(match.group(2) or "").upper()])
+
+# Read exactly n bytes from a socket
+def recv_exact(sock, n, buf=None):
+    buf = buf or bytearray(min(n, 1 << 20))
+    view = memoryview(buf)
+    remaining = n
+    while remaining:
+        got = sock.recv_into(view[:min(remaining, len(buf))])
+        if not got:
+            raise ConnectionError("peer closed the connection")
+        remaining -= got
+    return bytes(buf[:min(n, len(buf))])
+
+# Nearest-rank percentile of a list of samples, shared with launch.py
+def percentile(values, q):
+    """
+    :param list values: Sample of numbers
+    :param float q: Percentile in [0, 100]
+    :return float: Smallest value at or above which q% of the sample lies, or NaN for
+        an empty sample
+    """
+
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[max(0, min(len(values) - 1, math.ceil(q / 100 * len(values)) - 1))]
+
+class BenchHandler(socketserver.BaseRequestHandler):
+    """
+    Serves the network benchmark. Each request starts with an op byte: b"P" echoes a
+    64 byte ping, and b"S" followed by a 64-bit length sinks that many bytes and
+    acknowledges them with b"K".
+    """
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buf = bytearray(1 << 20)
+        while True:
+            op = sock.recv(1)
+            if op == b"P":
+                sock.sendall(recv_exact(sock, 64))
+            elif op == b"S":
+                length, = struct.unpack("!Q", recv_exact(sock, 8))
+                recv_exact(sock, length, buf)
+                sock.sendall(b"K")
+            else:
+                return
+
+class BenchServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+# Connect to a peer, retrying while its server starts
+def connect(host, port, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            sock = socket.create_connection((host, port), timeout=timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+def net(peers, size, pings=200):
+    """
+    Measures latency and bandwidth from this node to each peer, one peer at a time.
+
+    :param list peers: host:port of the peers' servers
+    :param int size: Bytes sent to each peer for the bandwidth measurement
+    :param int pings: Number of round trips for the latency measurement
+    :return dict: Mapping of peer -> latency (half round trip) and bandwidth
+    """
+
+    payload = memoryview(os.urandom(min(size, 1 << 20)))
+    results = {}
+    for peer in peers:
+        host, _, port = peer.rpartition(":")
+        with connect(host, int(port)) as sock:
+            rtts = []
+            ping = b"P" + bytes(64)
+            for _ in range(pings):
+                start = time.perf_counter()
+                sock.sendall(ping)
+                recv_exact(sock, 64)
+                rtts.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            sock.sendall(b"S" + struct.pack("!Q", size))
+            remaining = size
+            while remaining:
+                chunk = payload[:min(remaining, len(payload))]
+                sock.sendall(chunk)
+                remaining -= len(chunk)
+            recv_exact(sock, 1)
+            elapsed = time.perf_counter() - start
+
+        results[peer] = {"latency_us": statistics.median(rtts) / 2 * 1e6,
+                         "latency_p99_us": percentile(rtts, 99) / 2 * 1e6,
+                         "bandwidth_gbps": size * 8 / elapsed / 1e9}
+    return results
+
+def disk(path, size, block=4 << 20):
+    """
+    Measures sequential write (including fsync) and read throughput of a file system.
+    The page cache is dropped for the file between the two, so reads hit the disk.
+
+    :param str path: Directory on the file system
+    :param int size: Bytes written and read back
+    :param int block: Bytes per write/read call
+    :return dict: Throughput in MB/s
+    """
+
+    buf = os.urandom(block)
+    fd, fname = tempfile.mkstemp(prefix="mars_bench_", dir=path)
+    try:
+        start = time.perf_counter()
+        written = 0
+        while written < size:
+            written += os.write(fd, buf)
+        os.fsync(fd)
+        write_time = time.perf_counter() - start
+
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.lseek(fd, 0, os.SEEK_SET)
+        start = time.perf_counter()
+        while os.read(fd, block):
+            pass
+        read_time = time.perf_counter() - start
+    finally:
+        os.close(fd)
+        os.remove(fname)
+
+    return {"path": path,
+            "write_mb_s": written / write_time / 1e6,
+            "read_mb_s": written / read_time / 1e6}
+
+def allreduce(rank, world_size, master_addr, master_port, sizes, backend="auto", iters=20, warmup=5):
+    """
+    Measures torch.distributed allreduce at several message sizes. Bus bandwidth
+    scales the algorithm bandwidth by 2(n-1)/n, the share of the data each rank
+    sends in a ring allreduce, so it is comparable across world sizes.
+
+    :param int rank: Rank of this node
+    :param int world_size: Number of nodes
+    :param str master_addr: Address of rank 0
+    :param int master_port: Free port on rank 0
+    :param list sizes: Message sizes in bytes
+    :param str backend: gloo, nccl, or auto (nccl when a GPU is available)
+    :param int iters: Timed allreduces per size
+    :param int warmup: Untimed allreduces per size
+    :return dict: Mapping of size -> time and bandwidths
+    """
+
+    # imported here, as the launcher imports this module without needing torch
+    try:
+        import torch
+        import torch.distributed as dist
+    except ImportError:
+        return {"skipped": "torch is not installed"}
+
+    if backend == "auto":
+        backend = "nccl" if torch.cuda.is_available() and dist.is_nccl_available() else "gloo"
+    device = torch.device("cuda", 0) if backend == "nccl" else torch.device("cpu")
+
+    dist.init_process_group(backend, init_method=f"tcp://{master_addr}:{master_port}",
+                            rank=rank, world_size=world_size)
+    results = {"backend": backend}
+    try:
+        for size in sizes:
+            tensor = torch.ones(max(1, size // 4), dtype=torch.float32, device=device)
+            for _ in range(warmup):
+                dist.all_reduce(tensor)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            dist.barrier()
+
+            start = time.perf_counter()
+            for _ in range(iters):
+                dist.all_reduce(tensor)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            elapsed = (time.perf_counter() - start) / iters
+
+            algbw = size / elapsed / 1e9
+            results[str(size)] = {"time_us": elapsed * 1e6,
+                                  "algbw_gb_s": algbw,
+                                  "busbw_gb_s": algbw * 2 * (world_size - 1) / world_size}
+    finally:
+        dist.destroy_process_group()
+    return results
+
+def dask_throughput(scheduler, tasks=10000):
+    """
+    Measures how many trivial tasks per second the Dask scheduler gets through.
+
+    :param str scheduler: Address of the scheduler
+    :param int tasks: Number of tasks submitted
+    :return dict: Task throughput
+    """
+
+    try:
+        from distributed import Client
+    except ImportError:
+        return {"skipped": "distributed is not installed"}
+
+    with Client(scheduler, timeout=30) as client:
+        workers = len(client.scheduler_info()["workers"])
+        start = time.perf_counter()
+        client.gather(client.map(abs, range(tasks), pure=False))
+        elapsed = time.perf_counter() - start
+
+    return {"tasks": tasks, "workers": workers, "tasks_per_s": tasks / elapsed}
+
+# Runs the benchmarks on local processes standing in for nodes
+class LocalRunner:
+    """
+    :param int n_nodes: Number of emulated nodes
+    """
+
+    def __init__(self, n_nodes):
+        self.nodes = [{"rank": rank, "address": "127.0.0.1"} for rank in range(n_nodes)]
+
+    def prepare(self):
+        pass
+
+    def spawn(self, node, argv, image=None):
+        return sp.Popen([sys.executable, BENCH_SCRIPT, *argv], stdout=sp.PIPE, stderr=sp.PIPE,
+                        universal_newlines=True)
+
+    def stop(self, node, proc):
+        proc.terminate()
+        proc.wait()
+
+# Runs the benchmarks on the cluster's nodes over SSH
+class SSHRunner:
+    """
+    :param ClusterInventory cluster: Inventory of the cluster
+    :param str key: SSH private key for the nodes
+    :param str user: SSH user
+    """
+
+    def __init__(self, cluster, key, user="ubuntu"):
+        self.nodes = [{"rank": node["rank"], "address": node["private_ip"], "host": node["public_ip"],
+                       "gpus": node.get("gpus")} for node in cluster]
+        self.key = key
+        self.user = user
+
+    def _ssh(self, node):
+        return ["ssh", "-i", self.key, "-o", "StrictHostKeyChecking=no", f"{self.user}@{node['host']}"]
+
+    def prepare(self):
+        """
+        Copies this script to every node.
+        """
+
+        def copy(node):
+            sp.run(["scp", "-i", self.key, "-o", "StrictHostKeyChecking=no", BENCH_SCRIPT,
+                    f"{self.user}@{node['host']}:{REMOTE_SCRIPT}"], stdout=sp.DEVNULL, check=True)
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            list(pool.map(copy, self.nodes))
+
+    def spawn(self, node, argv, image=None):
+        """
+        :param dict node: Node
+        :param list argv: Benchmark subcommand and its arguments
+        :param str image: Docker image to run the benchmark in, for dependencies
+            (torch, distributed) the host lacks
+        """
+
+        if image is None:
+            cmd = ["python3", REMOTE_SCRIPT, *argv]
+        else:
+            cmd = ["sudo", "docker", "run", "--rm", "--network", "host", "-v", f"{REMOTE_SCRIPT}:/mars_bench.py"]
+            if node.get("gpus"):
+                cmd += ["--gpus", "all"]
+            cmd += [image, "python", "/mars_bench.py", *argv]
+        return sp.Popen(self._ssh(node) + [" ".join(map(shlex.quote, cmd))],
+                        stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+
+    def stop(self, node, proc):
+        sp.run(self._ssh(node) + [f"pkill -f '{REMOTE_SCRIPT} serve'"], stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        proc.terminate()
+        proc.wait()
+
+# Wait for a benchmark process and parse its results
+def collect(proc):
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        return {"error": err.strip().splitlines()[-1] if err.strip() else f"exit status {proc.returncode}"}
+    return json.loads(out)
+
+def run_suite(runner, benchmarks=("net", "disk", "allreduce", "dask"), net_size=256 << 20, pings=200,
+              port=29600, disk_path="/tmp", disk_size=1 << 30, sizes=(1 << 10, 1 << 20, 64 << 20),
+              backend="auto", image=None, scheduler=None, dask_image=None, tasks=10000, log=print):
+    """
+    Runs the benchmark suite over the runner's nodes.
+
+    :param runner: LocalRunner or SSHRunner
+    :param tuple benchmarks: Benchmarks to run
+    :param int net_size: Bytes sent between each pair of nodes
+    :param int pings: Round trips timed between each pair of nodes
+    :param int port: Base port of the network servers (rank is added) and allreduce
+    :param str disk_path: Directory whose file system is benchmarked on each node
+    :param int disk_size: Bytes written and read on each node
+    :param tuple sizes: Allreduce message sizes in bytes
+    :param str backend: Allreduce backend
+    :param str image: Docker image to run allreduce in
+    :param str scheduler: Address of the Dask scheduler, as seen from rank 0. The Dask
+        benchmark is skipped without one
+    :param str dask_image: Docker image to run the Dask benchmark in
+    :param int tasks: Tasks submitted to the Dask scheduler
+    :param callable log: Progress output
+    :return dict: Results
+    """
+
+    nodes = runner.nodes
+    results = {"time": time.time(), "nodes": len(nodes), "net": {}, "disk": {}, "allreduce": {}, "dask": {}}
+    runner.prepare()
+
+    if "net" in benchmarks and len(nodes) > 1:
+        log(f"Measuring bandwidth and latency between {len(nodes) * (len(nodes) - 1)} node pairs...")
+        servers = [(node, runner.spawn(node, ["serve", "--port", str(port + node["rank"])])) for node in nodes]
+        try:
+            for node in nodes:
+                peers = {f"{peer['address']}:{port + peer['rank']}": peer["rank"] for peer in nodes if peer is not node}
+                pairs = collect(runner.spawn(node, ["net", "--peers", ",".join(peers), "--size", str(net_size),
+                                                   "--pings", str(pings)]))
+                for peer, rank in peers.items():
+                    results["net"][f"{node['rank']}->{rank}"] = pairs.get(peer, pairs)
+        finally:
+            for node, proc in servers:
+                runner.stop(node, proc)
+
+    if "disk" in benchmarks:
+        log(f"Measuring disk throughput of {disk_path} on {len(nodes)} nodes...")
+        procs = [runner.spawn(node, ["disk", "--path", disk_path, "--size", str(disk_size)]) for node in nodes]
+        for node, proc in zip(nodes, procs):
+            results["disk"][str(node["rank"])] = collect(proc)
+
+    if "allreduce" in benchmarks:
+        log(f"Measuring allreduce over {len(nodes)} nodes...")
+        argv = ["allreduce", "--world-size", str(len(nodes)), "--master-addr", nodes[0]["address"],
+                "--master-port", str(port + len(nodes)), "--sizes", ",".join(map(str, sizes)),
+                "--backend", backend]
+        procs = [runner.spawn(node, argv + ["--rank", str(node["rank"])], image=image) for node in nodes]
+        results["allreduce"] = [collect(proc) for proc in procs][0]
+
+    if "dask" in benchmarks:
+        if scheduler is None:
+            results["dask"] = {"skipped": "no scheduler"}
+        else:
+            log(f"Measuring Dask scheduler throughput with {tasks} tasks...")
+            results["dask"] = collect(runner.spawn(nodes[0], ["dask", "--scheduler", scheduler,
+                                                              "--tasks", str(tasks)], image=dask_image))
+
+    return results
+
+# Numeric metrics of a results dictionary, keyed by their path
+def flatten(results, prefix=""):
+    metrics = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            metrics.update(flatten(value, f"{path}."))
+        elif isinstance(value, (int, float)) and key.endswith(("_us", "_gbps", "_gb_s", "_mb_s", "_per_s")):
+            metrics[path] = value
+    return metrics
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compares results against a baseline run. Latencies (_us) regress when they grow,
+    every other metric when it shrinks.
+
+    :param dict results: Results of this run
+    :param dict baseline: Results of the baseline run
+    :param float tolerance: Relative change tolerated before a metric counts as regressed
+    :return list: (metric, baseline, current, relative change, regressed) tuples
+    """
+
+    current, previous = flatten(results), flatten(baseline)
+    rows = []
+    for metric in sorted(current.keys() & previous.keys()):
+        old, new = previous[metric], current[metric]
+        change = (new - old) / old if old else 0.0
+        worse = change > tolerance if metric.endswith("_us") else change < -tolerance
+        rows.append((metric, old, new, change, worse))
+    return rows
+
+def summarize(results):
+    """
+    :param dict results: Results of run_suite
+    :return list: Lines of a human readable summary
+    """
+
+    lines = []
+    for pair, res in results["net"].items():
+        if "error" in res:
+            lines.append(f"net {pair:>10}: {res['error']}")
+        else:
+            lines.append(f"net {pair:>10}: {res['bandwidth_gbps']:8.2f} Gbit/s  {res['latency_us']:8.1f} us "
+                         f"(p99 {res['latency_p99_us']:.1f} us)")
+    for rank, res in results["disk"].items():
+        if "error" in res:
+            lines.append(f"disk rank {rank}: {res['error']}")
+        else:
+            lines.append(f"disk rank {rank}: write {res['write_mb_s']:8.1f} MB/s  read {res['read_mb_s']:8.1f} MB/s")
+    for size, res in results["allreduce"].items():
+        if isinstance(res, dict) and "busbw_gb_s" in res:
+            lines.append(f"allreduce {int(size):>12} B: {res['time_us']:10.1f} us  busbw {res['busbw_gb_s']:.2f} GB/s")
+    for name in ("allreduce", "dask"):
+        for key in ("skipped", "error"):
+            if key in results[name]:
+                lines.append(f"{name}: {key} ({results[name][key]})")
+    if "tasks_per_s" in results["dask"]:
+        lines.append(f"dask: {results['dask']['tasks_per_s']:.0f} tasks/s over {results['dask']['workers']} workers")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mars cluster benchmarks")
+    subparsers = parser.add_subparsers(dest="bench")
+
+    serve_parser = subparsers.add_parser("serve", help="Serve the network benchmark")
+    serve_parser.add_argument("--port", type=int, required=True)
+
+    net_parser = subparsers.add_parser("net", help="Latency and bandwidth to peers")
+    net_parser.add_argument("--peers", required=True, help="Comma separated host:port of peers")
+    net_parser.add_argument("--size", default="256MB")
+    net_parser.add_argument("--pings", type=int, default=200)
+
+    disk_parser = subparsers.add_parser("disk", help="Disk throughput")
+    disk_parser.add_argument("--path", default="/tmp")
+    disk_parser.add_argument("--size", default="1GB")
+
+    allreduce_parser = subparsers.add_parser("allreduce", help="torch.distributed allreduce bandwidth")
+    allreduce_parser.add_argument("--rank", type=int, required=True)
+    allreduce_parser.add_argument("--world-size", type=int, required=True)
+    allreduce_parser.add_argument("--master-addr", required=True)
+    allreduce_parser.add_argument("--master-port", type=int, required=True)
+    allreduce_parser.add_argument("--sizes", default="1KB,1MB,64MB")
+    allreduce_parser.add_argument("--backend", default="auto", choices=["auto", "gloo", "nccl"])
+
+    dask_parser = subparsers.add_parser("dask", help="Dask scheduler task throughput")
+    dask_parser.add_argument("--scheduler", required=True)
+    dask_parser.add_argument("--tasks", type=int, default=10000)
+
+    args = parser.parse_args()
+
+    if args.bench == "serve":
+        with BenchServer(("0.0.0.0", args.port), BenchHandler) as server:
+            server.serve_forever()
+    elif args.bench == "net":
+        result = net(args.peers.split(","), parse_size(args.size), args.pings)
+    elif args.bench == "disk":
+        result = disk(args.path, parse_size(args.size))
+    elif args.bench == "allreduce":
+        result = allreduce(args.rank, args.world_size, args.master_addr, args.master_port,
+                           [parse_size(size) for size in args.sizes.split(",")], args.backend)
+    elif args.bench == "dask":
+        result = dask_throughput(args.scheduler, args.tasks)
+    else:
+        parser.error("missing benchmark")
+
+    print(json.dumps(result))
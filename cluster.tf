@@ -101,6 +101,11 @@ resource "aws_spot_instance_request" "ec2-master" {
   #   destination = "/tmp/init"
   # }
 
+  # provisioner "file" {
+  #   source      = "scripts/agent.py"
+  #   destination = "/tmp/init/agent.py"
+  # }
+
   # provisioner "file" {
   #   content     = data.template_file.master_init.rendered
   #   destination = "/tmp/init/init.sh"
@@ -170,12 +175,18 @@ resource "aws_autoscaling_group" "ec2-cluster-asg" {
 
   depends_on = [aws_spot_instance_request.ec2-master]
 
+  # mars scale changes the capacity of a running cluster
+  lifecycle {
+    ignore_changes = [desired_capacity]
+  }
+
   # provisioner "local-exec" {
   #   command = <<EOT
   #     echo ${self.id} > artifacts/asg_id.txt
   #     aws s3 cp key/ s3://${var.config_s3_bucket}/mars/${aws_spot_instance_request.ec2-master.id}/key --recursive
   #     aws s3 cp config/${var.cluster_type}/ s3://${var.config_s3_bucket}/mars/${aws_spot_instance_request.ec2-master.id}/config --recursive
   #     aws s3 cp scripts/worker/ s3://${var.config_s3_bucket}/mars/${aws_spot_instance_request.ec2-master.id}/init --recursive
+  #     aws s3 cp scripts/agent.py s3://${var.config_s3_bucket}/mars/${aws_spot_instance_request.ec2-master.id}/init/agent.py
   #     aws s3 cp artifacts/ s3://${var.config_s3_bucket}/mars/${aws_spot_instance_request.ec2-master.id}/artifacts --recursive
   #   EOT
   # }
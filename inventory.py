@@ -0,0 +1,331 @@
+"""
+Structured inventory of the nodes in a Mars cluster, shared by launch.py and mars.py.
+
+The inventory is built from `terraform output -json` (saved by scripts/create.sh as
+artifacts/terraform_output.json) and cached as artifacts/inventory.json alongside the
+mtime and hash of that file, so it is only rebuilt when that changes. The terraform state
+is kept in S3, so commands that change the cluster rewrite the saved output with
+save_terraform_output for the change to reach the inventory.
+"""
+
+import hashlib
+import json
+import os
+import subprocess as sp
+
+INVENTORY_FILE = "inventory.json"
+TF_OUTPUT_FILE = "terraform_output.json"
+TOPOLOGY_FILE  = "topology.json"
+
+
+# Hash of a file's contents
+def file_digest(path):
+    """
+    :param str path: Path of file
+    :return str: SHA-256 hex digest of the file
+    """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Indexed view over the nodes of a cluster
+class ClusterInventory:
+    """
+    Nodes of a cluster, indexed by rank, role and host. Each node is a dictionary with
+    keys rank, role, public_ip, private_ip, instance_id, instance_type and gpus; the
+    master is rank 0 and workers follow in terraform output order.
+
+    :param list nodes: List of node dictionaries
+    :param dict source: Description (path, mtime, sha256) of the file the inventory
+        was built from
+    """
+
+    def __init__(self, nodes, source=None):
+        self.nodes = sorted(nodes, key=lambda node: node["rank"])
+        self.source = source or {}
+
+        self._by_rank = {node["rank"]: node for node in self.nodes}
+        self._by_host = {}
+        for node in self.nodes:
+            for key in ("public_ip", "private_ip", "instance_id"):
+                if node.get(key):
+                    self._by_host[node[key]] = node
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def by_rank(self, rank):
+        return self._by_rank[rank]
+
+    def by_host(self, host):
+        """
+        :param str host: Public IP, private IP or instance ID of a node
+        :return dict: Node
+        """
+
+        return self._by_host[host]
+
+    def by_role(self, role):
+        return [node for node in self.nodes if node["role"] == role]
+
+    @property
+    def master(self):
+        return self.by_role("master")[0]
+
+    @property
+    def workers(self):
+        return self.by_role("worker")
+
+    def public_ips(self, role=None):
+        """
+        :param str role: Only nodes of this role. Defaults to every node
+        :return dict: Mapping of rank -> public IP
+        """
+
+        return {node["rank"]: node["public_ip"] for node in self.nodes
+                if role is None or node["role"] == role}
+
+    def private_ips(self, role=None):
+        """
+        :param str role: Only nodes of this role. Defaults to every node
+        :return dict: Mapping of rank -> private IP
+        """
+
+        return {node["rank"]: node["private_ip"] for node in self.nodes
+                if role is None or node["role"] == role}
+
+    def to_dict(self):
+        return {"source": self.source, "nodes": self.nodes}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["nodes"], data.get("source"))
+
+    @classmethod
+    def from_terraform_output(cls, tf_output, source=None):
+        """
+        :param dict tf_output: Parsed `terraform output -json`
+        :param dict source: Description of the file the output was read from
+        :return ClusterInventory: Inventory of the cluster
+        """
+
+        def value(key, default=None):
+            return tf_output.get(key, {}).get("value", default)
+
+        worker_pub = value("worker_instance_public_ips", [])
+        worker_pvt = value("worker_instance_private_ips", [])
+        worker_ids = value("worker_instance_ids", [])
+        instance_type = value("instance_type")
+
+        nodes = [{"rank": 0,
+                  "role": "master",
+                  "public_ip": value("master_public_ip"),
+                  "private_ip": value("master_private_ip"),
+                  "instance_id": value("master_instance_id"),
+                  "instance_type": instance_type,
+                  "gpus": None}]
+        for idx, public_ip in enumerate(worker_pub):
+            nodes.append({"rank": idx + 1,
+                          "role": "worker",
+                          "public_ip": public_ip,
+                          "private_ip": worker_pvt[idx] if idx < len(worker_pvt) else None,
+                          "instance_id": worker_ids[idx] if idx < len(worker_ids) else None,
+                          "instance_type": instance_type,
+                          "gpus": None})
+
+        return cls(nodes, source)
+
+    @classmethod
+    def from_text_artifacts(cls, artifact_path):
+        """
+        Builds an inventory from the legacy master_*.txt/worker_*.txt artifact files.
+
+        :param str artifact_path: Path where cluster artifacts are stored
+        :return ClusterInventory: Inventory of the cluster
+        """
+
+        def read_ips(fname):
+            path = os.path.join(artifact_path, fname)
+            if not os.path.isfile(path):
+                return []
+            with open(path, "r", encoding="utf-8") as f:
+                return [line.strip().strip("\"") for line in f if line.strip()]
+
+        tf_output = {"master_public_ip": {"value": read_ips("master_public.txt")[0]},
+                     "master_private_ip": {"value": read_ips("master_private.txt")[0]},
+                     "worker_instance_public_ips": {"value": read_ips("worker_public.txt")},
+                     "worker_instance_private_ips": {"value": read_ips("worker_private.txt")}}
+        master_id = read_ips("master_id.txt")
+        if master_id:
+            tf_output["master_instance_id"] = {"value": master_id[0]}
+
+        return cls.from_terraform_output(tf_output)
+
+    def annotate_gpus(self, topologies):
+        """
+        Fills in GPU counts from the launcher's topology cache.
+
+        :param dict topologies: Mapping of instance ID (or host) -> topology, as cached
+            by launch.py
+        """
+
+        for node in self.nodes:
+            topo = topologies.get(node["instance_id"]) or topologies.get(node["public_ip"])
+            if topo is not None:
+                node["gpus"] = topo["gpus"]
+
+# List the running workers of the cluster's autoscaling group from the EC2 API
+def discover_workers(artifact_path, aws="aws", region=None, profile=None):
+    """
+    Lists the in-service instances of the worker autoscaling group. Unlike the terraform
+    output, which only changes on the next apply, this includes the instances the group
+    launched to replace lost ones (e.g. reclaimed spot instances).
+
+    :param str artifact_path: Path where cluster artifacts are stored
+    :param str aws: AWS CLI executable
+    :param str region: AWS region. Defaults to the CLI's configuration
+    :param str profile: AWS profile. Defaults to the CLI's configuration
+    :return list: Workers, as dictionaries with keys instance_id, public_ip and
+        private_ip, or None if the terraform output names no autoscaling group
+    """
+
+    tf_output_path = os.path.join(artifact_path, TF_OUTPUT_FILE)
+    if not os.path.isfile(tf_output_path):
+        return None
+    with open(tf_output_path, "r") as f:
+        asg_name = json.load(f).get("worker_asg_name", {}).get("value")
+    if not asg_name:
+        return None
+
+    def aws_json(*args):
+        cmd = [aws, "--output", "json"]
+        if region is not None:
+            cmd += ["--region", region]
+        if profile is not None:
+            cmd += ["--profile", profile]
+        out = sp.run(cmd + list(args), stdout=sp.PIPE, check=True, universal_newlines=True)
+        return json.loads(out.stdout)
+
+    groups = aws_json("autoscaling", "describe-auto-scaling-groups",
+                      "--auto-scaling-group-names", asg_name)["AutoScalingGroups"]
+    ids = [inst["InstanceId"] for group in groups for inst in group["Instances"]
+           if inst["LifecycleState"] == "InService"]
+    if not ids:
+        return []
+
+    instances = {inst["InstanceId"]: inst
+                 for reservation in aws_json("ec2", "describe-instances", "--instance-ids", *ids)["Reservations"]
+                 for inst in reservation["Instances"]}
+    return [{"instance_id": instance_id,
+             "public_ip": instances[instance_id].get("PublicIpAddress"),
+             "private_ip": instances[instance_id].get("PrivateIpAddress")}
+            for instance_id in ids
+            if instance_id in instances and instances[instance_id]["State"]["Name"] == "running"]
+
+# Save the output of the current terraform state, which the inventory is built from
+def save_terraform_output(artifact_path, tf_dir):
+    """
+    Runs `terraform output -json` and atomically replaces the saved terraform output,
+    so that the next load_inventory rebuilds the inventory if the cluster changed.
+
+    :param str artifact_path: Path where cluster artifacts are stored
+    :param str tf_dir: Terraform working directory of the cluster
+    :return str: Path of the saved terraform output
+    """
+
+    out = sp.run(["terraform", "output", "-json"], cwd=tf_dir, stdout=sp.PIPE, check=True,
+                 universal_newlines=True)
+    json.loads(out.stdout)  # never replace the saved output with something unparsable
+
+    tf_output_path = os.path.join(artifact_path, TF_OUTPUT_FILE)
+    tmp_path = f"{tf_output_path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(out.stdout)
+    os.replace(tmp_path, tf_output_path)
+    return tf_output_path
+
+# Load the inventory of a cluster, rebuilding it only when its source changed
+_memo = {}
+
+def load_inventory(artifact_path, state_path=None):
+    """
+    Loads the cluster inventory. The cached artifacts/inventory.json is reused as long as
+    the saved terraform output it was built from is unchanged: an equal mtime skips all
+    work, and on a changed mtime the file is re-hashed, so touching it without changing
+    it does not force a rebuild. Without a saved output, the legacy text artifacts are
+    parsed.
+
+    Only clusters with a local terraform backend have a state file; when one is given
+    and is newer than the saved output, the output is saved again first. With the S3
+    backend of cluster.tf there is none, and commands that change the cluster call
+    save_terraform_output themselves.
+
+    :param str artifact_path: Path where cluster artifacts are stored
+    :param str state_path: Terraform state file, for local backends only
+    :return ClusterInventory: Inventory of the cluster
+    """
+
+    tf_output_path = os.path.join(artifact_path, TF_OUTPUT_FILE)
+    cache_path = os.path.join(artifact_path, INVENTORY_FILE)
+
+    if state_path is not None and os.path.isfile(state_path):
+        if (not os.path.isfile(tf_output_path) or
+                os.stat(state_path).st_mtime > os.stat(tf_output_path).st_mtime):
+            save_terraform_output(artifact_path, os.path.dirname(os.path.abspath(state_path)))
+
+    if not os.path.isfile(tf_output_path):
+        return ClusterInventory.from_text_artifacts(artifact_path)
+    source_path = tf_output_path
+
+    mtime = os.stat(source_path).st_mtime
+
+    # In-process memo, keyed by source mtime
+    memo = _memo.get(cache_path)
+    if memo is not None and memo.source.get("path") == source_path and memo.source.get("mtime") == mtime:
+        return memo
+
+    cached = None
+    if os.path.isfile(cache_path):
+        with open(cache_path, "r") as f:
+            cached = ClusterInventory.from_dict(json.load(f))
+
+    if cached is not None and cached.source.get("path") == source_path:
+        if cached.source.get("mtime") == mtime:
+            _memo[cache_path] = cached
+            return cached
+
+        digest = file_digest(source_path)
+        if cached.source.get("sha256") == digest:
+            cached.source["mtime"] = mtime
+            _save(cached, cache_path)
+            _memo[cache_path] = cached
+            return cached
+    else:
+        digest = file_digest(source_path)
+
+    # Stale or missing: rebuild from the terraform output
+    with open(tf_output_path, "r") as f:
+        tf_output = json.load(f)
+    inventory = ClusterInventory.from_terraform_output(
+        tf_output, source={"path": source_path, "mtime": mtime, "sha256": digest})
+
+    topology_path = os.path.join(artifact_path, TOPOLOGY_FILE)
+    if os.path.isfile(topology_path):
+        with open(topology_path, "r") as f:
+            inventory.annotate_gpus(json.load(f))
+
+    _save(inventory, cache_path)
+    _memo[cache_path] = inventory
+    return inventory
+
+def _save(inventory, cache_path):
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(inventory.to_dict(), f, indent=2)
+    os.replace(tmp_path, cache_path)
@@ -1,11 +1,28 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
+import shlex
 import subprocess as sp
 import sys
 import os
+import time
 from pathlib import Path
 
+from inventory import TF_OUTPUT_FILE, load_inventory, save_terraform_output
+
+# Run in the scheduler container on the master to gracefully retire the workers on the
+# hosts given as arguments: Dask moves their data to the remaining workers first
+RETIRE_WORKERS = """
+import sys
+from distributed import Client
+hosts = set(sys.argv[1:])
+with Client("tcp://127.0.0.1:8786", timeout=30) as client:
+    workers = [addr for addr, info in client.scheduler_info()["workers"].items() if info["host"] in hosts]
+    client.retire_workers(workers=workers, close_workers=True)
+    print(len(workers))
+"""
+
 
 class MarsCLI:
     """
@@ -20,19 +37,27 @@ class MarsCLI:
 
 Commands are as follows:
     create      Creates a Mars cluster of a specified configuration
+    scale       Adds (+N) or drains (-N) worker nodes of a running cluster
+    bench       Benchmarks network, allreduce, disk and scheduler performance
+    status      Shows the health of the cluster's nodes, optionally collecting metrics
+    inventory   Lists the nodes of the cluster
     connect     Opens an SSH connection to the master node
     destroy     Teardown the cluster
         """)
         parser.add_argument("command", help="Command to use")
 
         args = parser.parse_args(self.main_arg)
+        self.root = Path(__file__).parent
         self.tf_config = {}
+        self._inventory = None
 
-        with open(Path(__file__).parent.joinpath("terraform.tfvars"), "r") as f:
-            for line in f:
-                entry = list(map(lambda x: x.strip().strip("\""), line.split("=")))
-                if len(entry) > 1:
-                    self.tf_config[entry[0]] = entry[1]
+        tfvars = Path(__file__).parent.joinpath("terraform.tfvars")
+        if tfvars.is_file():
+            with open(tfvars, "r") as f:
+                for line in f:
+                    entry = list(map(lambda x: x.strip().strip("\""), line.split("=")))
+                    if len(entry) > 1:
+                        self.tf_config[entry[0]] = entry[1]
 
         if not hasattr(self, args.command):
             print("Unrecognized command")
@@ -40,6 +65,38 @@ Commands are as follows:
         else:
             getattr(self, args.command)()
 
+    @property
+    def cluster(self):
+        """
+        Structured inventory of the running cluster, rebuilt only when terraform's
+        output has changed since it was last cached.
+        """
+
+        if self._inventory is None:
+            self._inventory = load_inventory(self.root.joinpath("artifacts"),
+                                             state_path=self.root.joinpath("terraform.tfstate"))
+        return self._inventory
+
+    def inventory(self):
+        parser = argparse.ArgumentParser(
+            description="Lists the nodes of the cluster",
+            usage="mars inventory [<args>]")
+        parser.add_argument("-r", "--role", default=None, choices=["master", "worker"], help="Only list nodes of this role")
+        parser.add_argument("--json", action="store_true", help="Print the inventory as JSON")
+
+        args = parser.parse_args(self.command_arg)
+
+        nodes = [node for node in self.cluster if args.role is None or node["role"] == args.role]
+        if args.json:
+            print(json.dumps(nodes, indent=2))
+            return
+
+        print(f"{'rank':>4}  {'role':<7} {'public ip':<16} {'private ip':<16} {'instance':<20} {'type':<12} gpus")
+        for node in nodes:
+            print(f"{node['rank']:>4}  {node['role']:<7} {node['public_ip'] or '-':<16} {node['private_ip'] or '-':<16} "
+                  f"{node['instance_id'] or '-':<20} {node['instance_type'] or '-':<12} "
+                  f"{'-' if node['gpus'] is None else node['gpus']}")
+
     def create(self):
         parser = argparse.ArgumentParser(
             description="Creates a Mars cluster of a specified configuration",
@@ -64,6 +121,229 @@ Commands are as follows:
         filep = Path(__file__).parent.joinpath("scripts/create.sh")
         sp.run([filep, args.key, args.num_nodes, args.instance])
 
+    def status(self):
+        parser = argparse.ArgumentParser(
+            description="Shows the health of the cluster's nodes, optionally collecting metrics",
+            usage="mars status [<args>]")
+        parser.add_argument("-k", "--key", default=None, type=str, help="SSH private key for EC2 nodes")
+        parser.add_argument("--local", action="store_true", help="Poll this machine instead of the cluster")
+        parser.add_argument("-w", "--watch", default=None, type=float, help="Keep polling every WATCH seconds, collecting metrics")
+        parser.add_argument("--duration", default=None, type=float, help="Stop watching after this many seconds")
+        parser.add_argument("--capacity", default=8640, type=int, help="Samples kept per node and metric while watching")
+        parser.add_argument("--window", default=1.0, type=float, help="Seconds over which CPU and network rates are measured")
+        parser.add_argument("--export", default=None, help="Write collected metrics to a .csv or .parquet file")
+
+        args = parser.parse_args(self.command_arg)
+
+        # imported here, so other commands do not pay for its optional dependencies
+        import monitor
+        if args.export and args.export.endswith(".parquet") and monitor.pyarrow is None:
+            parser.error("Parquet export requires pyarrow, export to .csv instead")
+
+        if args.local:
+            nodes = [{"rank": 0, "role": "local", "public_ip": None}]
+        else:
+            nodes = list(self.cluster)
+        poller = monitor.NodePoller(nodes, key=args.key or self.tf_config.get("key_file"), window=args.window)
+        collector = monitor.MetricsCollector(poller, interval=args.watch or 0, capacity=args.capacity)
+
+        if args.watch is None:
+            collector.record(poller.poll())
+            print("\n".join(monitor.format_status(nodes, collector.latest)))
+        else:
+            collector.start()
+            start = time.time()
+            try:
+                while args.duration is None or time.time() - start < args.duration:
+                    time.sleep(args.watch)
+                    print(time.strftime("%H:%M:%S"))
+                    print("\n".join(monitor.format_status(nodes, collector.latest, collector.flags())))
+            except KeyboardInterrupt:
+                pass
+            finally:
+                collector.stop()
+
+        if args.export:
+            collector.export(args.export)
+            print(f"Metrics saved to {args.export}")
+
+    def bench(self):
+        parser = argparse.ArgumentParser(
+            description="Benchmarks network, allreduce, disk and scheduler performance",
+            usage="mars bench [<args>]")
+        parser.add_argument("-k", "--key", default=None, type=str, help="SSH private key for EC2 nodes")
+        parser.add_argument("--local", default=None, type=int, help="Run against this many local processes instead of the cluster")
+        parser.add_argument("--only", nargs="+", default=["net", "disk", "allreduce", "dask"],
+                            choices=["net", "disk", "allreduce", "dask"], help="Benchmarks to run")
+        parser.add_argument("--net-size", default="256MB", help="Data sent between each pair of nodes")
+        parser.add_argument("--disk-path", default="/tmp", help="Directory whose disk is benchmarked on each node")
+        parser.add_argument("--disk-size", default="1GB", help="Data written and read on each node")
+        parser.add_argument("--sizes", default="1KB,1MB,64MB", help="Comma separated allreduce message sizes")
+        parser.add_argument("--backend", default="auto", choices=["auto", "gloo", "nccl"], help="Allreduce backend")
+        parser.add_argument("--image", default=None, help="Docker image with torch to run allreduce in on the cluster")
+        parser.add_argument("--scheduler", default=None, help="Dask scheduler address. Defaults to the master's on the cluster")
+        parser.add_argument("--tasks", default=10000, type=int, help="Tasks submitted to the Dask scheduler")
+        parser.add_argument("-o", "--out", default=None, help="Results file. Defaults to artifacts/bench/<time>.json")
+        parser.add_argument("--compare", default=None, help="Results file of a baseline run to compare against")
+        parser.add_argument("--tolerance", default=0.1, type=float, help="Relative change flagged as a regression")
+
+        args = parser.parse_args(self.command_arg)
+
+        # imported here, so other commands do not pay for torch and dask
+        import bench
+        try:
+            net_size, disk_size = bench.parse_size(args.net_size), bench.parse_size(args.disk_size)
+            sizes = [bench.parse_size(size) for size in args.sizes.split(",")]
+        except ValueError as e:
+            parser.error(str(e))
+
+        if args.local:
+            runner = bench.LocalRunner(args.local)
+            scheduler, dask_image = args.scheduler, None
+        else:
+            runner = bench.SSHRunner(self.cluster, args.key or self.tf_config["key_file"])
+            scheduler = args.scheduler or "tcp://127.0.0.1:8786"
+            dask_image = self.tf_config.get("worker_image", "daskdev/dask:latest")
+
+        results = bench.run_suite(runner, benchmarks=args.only, net_size=net_size,
+                                  disk_path=args.disk_path, disk_size=disk_size, sizes=sizes,
+                                  backend=args.backend, image=args.image, scheduler=scheduler,
+                                  dask_image=dask_image, tasks=args.tasks)
+        print("\n".join(bench.summarize(results)))
+
+        out = args.out or self.root.joinpath("artifacts", "bench", time.strftime("%Y%m%d-%H%M%S.json"))
+        os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+        with open(out, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {out}")
+
+        if args.compare:
+            with open(args.compare, "r") as f:
+                baseline = json.load(f)
+            rows = bench.compare(results, baseline, args.tolerance)
+            for metric, old, new, change, worse in rows:
+                print(f"{'REGRESSED' if worse else '':<9} {metric:<40} {old:12.2f} -> {new:12.2f} ({change:+.1%})")
+            if any(row[-1] for row in rows):
+                sys.exit(1)
+
+    def _aws(self, *args):
+        """
+        Runs an AWS CLI command against the cluster's region and profile.
+
+        :return dict: Parsed JSON output
+        """
+
+        cmd = ["aws", "--region", self.tf_config.get("aws_region", "us-east-1"),
+               "--profile", self.tf_config.get("profile", "default"), "--output", "json", *args]
+        out = sp.run(cmd, stdout=sp.PIPE, check=True, universal_newlines=True)
+        return json.loads(out.stdout) if out.stdout.strip() else {}
+
+    def _refresh(self):
+        """
+        Re-reads the cluster's resources into the terraform state, without applying any
+        change, and saves its output so the inventory is rebuilt from it.
+        """
+
+        sp.run(["terraform", "refresh"], cwd=self.root, stdout=sp.DEVNULL, check=True)
+        save_terraform_output(self.root.joinpath("artifacts"), self.root)
+        self._inventory = None
+
+    def _write_ansible_inventory(self, key):
+        with open(self.root.joinpath("ansible/inventory"), "w") as f:
+            f.write("[master]\n")
+            f.write(f"{self.cluster.master['public_ip']} ansible_user=ubuntu\n")
+            f.write("\n[workers]\n")
+            for node in self.cluster.workers:
+                f.write(f"{node['public_ip']} ansible_user=ubuntu\n")
+            f.write("\n[mars:children]\nmaster\nworkers\n\n[mars:vars]\n"
+                    f"ansible_ssh_user=ubuntu\nansible_ssh_private_key_file={key}\n")
+
+    def scale(self):
+        parser = argparse.ArgumentParser(
+            description="Adds (+N) or drains (-N) worker nodes of a running cluster",
+            usage="mars scale [+N|-N] [<args>]")
+        parser.add_argument("delta", type=int, help="Number of workers to add (+N) or remove (-N)")
+        parser.add_argument("-k", "--key", default=None, type=str, help="SSH private key for EC2 nodes")
+        parser.add_argument("--timeout", default=600, type=int, help="Seconds to wait for new instances")
+        parser.add_argument("--force", action="store_true", help="Remove workers even if they could not be retired")
+
+        args = parser.parse_args(self.command_arg)
+        if args.key is None:
+            args.key = self.tf_config["key_file"]
+
+        with open(self.root.joinpath("artifacts", TF_OUTPUT_FILE), "r") as f:
+            asg_name = json.load(f)["worker_asg_name"]["value"]
+
+        if args.delta > 0:
+            self._scale_up(asg_name, args.delta, args.key, args.timeout)
+        elif args.delta < 0:
+            self._scale_down(-args.delta, args.key, args.force)
+
+        print(f"Cluster has {len(self.cluster.workers)} workers")
+
+    def _scale_up(self, asg_name, count, key, timeout):
+        asg = self._aws("autoscaling", "describe-auto-scaling-groups",
+                        "--auto-scaling-group-names", asg_name)["AutoScalingGroups"][0]
+        before = {inst["InstanceId"] for inst in asg["Instances"]}
+        desired = asg["DesiredCapacity"] + count
+        if desired > asg["MaxSize"]:
+            sys.exit(f"Cannot scale to {desired} workers, max_workers is {asg['MaxSize']}")
+
+        print(f"Scaling workers {asg['DesiredCapacity']} -> {desired}...")
+        self._aws("autoscaling", "set-desired-capacity", "--auto-scaling-group-name", asg_name,
+                  "--desired-capacity", str(desired))
+
+        # wait for the new instances to be in service
+        deadline = time.time() + timeout
+        while True:
+            asg = self._aws("autoscaling", "describe-auto-scaling-groups",
+                            "--auto-scaling-group-names", asg_name)["AutoScalingGroups"][0]
+            new = [inst["InstanceId"] for inst in asg["Instances"]
+                   if inst["InstanceId"] not in before and inst["LifecycleState"] == "InService"]
+            if len(new) >= count:
+                break
+            if time.time() > deadline:
+                sys.exit(f"Only {len(new)} of {count} new workers came up after {timeout}s")
+            time.sleep(10)
+        self._aws("ec2", "wait", "instance-status-ok", "--instance-ids", *new)
+
+        # initialize only the new workers, in parallel, and join them to the scheduler
+        self._refresh()
+        self._write_ansible_inventory(key)
+        hosts = [self.cluster.by_host(instance_id)["public_ip"] for instance_id in new]
+        print(f"Initializing {len(hosts)} new workers...")
+        env = dict(os.environ, ANSIBLE_CONFIG=str(self.root.joinpath("ansible/ansible.cfg")))
+        sp.run(["ansible-playbook", str(self.root.joinpath("ansible/playbook.yml")),
+                "--private-key", key,
+                "--inventory-file", str(self.root.joinpath("ansible/inventory")),
+                "--limit", ",".join(hosts),
+                "--extra-vars", f"master_private_ip={self.cluster.master['private_ip']}",
+                "--forks", str(len(hosts)),
+                "--user", "ubuntu",
+                "--timeout", "300"], env=env, check=True)
+
+    def _scale_down(self, count, key, force=False):
+        workers = self.cluster.workers
+        if count >= len(workers):
+            sys.exit(f"Cannot remove {count} of {len(workers)} workers, at least one must remain")
+        drained = workers[-count:]
+
+        # let Dask move data off the workers before their instances go away
+        print(f"Retiring {count} workers...")
+        retire = " ".join(["sudo", "docker", "exec", "dscheduler", "python", "-c", shlex.quote(RETIRE_WORKERS)]
+                          + [node["private_ip"] for node in drained])
+        out = sp.run(["ssh", "-i", key, "-o", "StrictHostKeyChecking=no",
+                      f"ubuntu@{self.cluster.master['public_ip']}", retire])
+        if out.returncode != 0 and not force:
+            sys.exit("Could not retire workers, not removing them (use --force to remove anyway)")
+
+        for node in drained:
+            self._aws("autoscaling", "terminate-instance-in-auto-scaling-group",
+                      "--instance-id", node["instance_id"], "--should-decrement-desired-capacity")
+
+        self._refresh()
+        self._write_ansible_inventory(key)
+
 
 if __name__ == "__main__":
     MarsCLI()
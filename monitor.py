@@ -0,0 +1,322 @@
+"""
+Health polling and metrics collection for the nodes of a Mars cluster, used by
+`mars status`.
+
+Each poll runs STATUS_PROBE on every node in parallel over SSH. The probe samples the
+CPU and network counters twice, a short window apart, so a single poll yields rates.
+MetricsCollector polls in the background and keeps every node's metrics in fixed-size
+ring buffers, so its memory is bounded however long it runs.
+"""
+
+import csv
+import json
+import math
+import subprocess as sp
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Prints counters twice, WINDOW seconds apart, then container and GPU state and the
+# time-to-ready report node init publishes once its containers are up
+STATUS_PROBE = r"""
+snapshot() {
+    echo "time=$(date +%s.%N)"
+    head -1 /proc/stat | sed 's/^cpu */cpu=/'
+    sed 's/:/ /' /proc/net/dev | awk 'NR > 2 && $1 != "lo" {rx += $2; tx += $10} END {printf "net=%.0f %.0f\n", rx, tx}'
+}
+snapshot
+sleep WINDOW
+snapshot
+awk '/^MemTotal:|^MemAvailable:/ {printf "%s=%s\n", substr($1, 1, length($1) - 1), $2}' /proc/meminfo
+{ docker ps -a --format 'container={{.Names}} {{.State}}' 2>/dev/null || sudo -n docker ps -a --format 'container={{.Names}} {{.State}}'; } 2>/dev/null
+nvidia-smi --query-gpu=utilization.gpu,memory.used,memory.total,clocks_throttle_reasons.active --format=csv,noheader,nounits 2>/dev/null | sed 's/^/gpu=/'
+[ -r READY_REPORT ] && echo "ready=$(tr -d '\n' < READY_REPORT)"
+"""
+
+# Where node init (scripts/agent.py) publishes the node's time-to-ready
+READY_REPORT = "/var/log/mars/ready.json"
+
+# Clock throttle reasons that mean a GPU is being slowed down: SW power cap, HW
+# slowdown, SW/HW thermal slowdown and power brake (idle and app clocks excluded)
+GPU_THROTTLE_MASK = 0x4 | 0x8 | 0x20 | 0x40 | 0x80
+
+METRICS = ("cpu", "steal", "mem", "gpu_util", "gpu_mem", "gpu_throttle", "rx_mb_s", "tx_mb_s", "running")
+
+
+# Parse the output of STATUS_PROBE
+def parse_status(output):
+    """
+    :param str output: Output of STATUS_PROBE on a node
+    :return dict: Sample with a value for each of METRICS (None where not applicable),
+        the list of containers and the node's time-to-ready report (None until init
+        has published it)
+    """
+
+    snapshots, mem, containers, gpus, ready = [], {}, [], [], None
+    for line in output.splitlines():
+        key, _, value = line.strip().partition("=")
+        if key == "time":
+            snapshots.append({"time": float(value)})
+        elif key == "cpu":
+            snapshots[-1]["cpu"] = [int(ticks) for ticks in value.split()]
+        elif key == "net":
+            snapshots[-1]["net"] = [int(count) for count in value.split()]
+        elif key in ("MemTotal", "MemAvailable"):
+            mem[key] = int(value)
+        elif key == "container":
+            name, _, state = value.partition(" ")
+            containers.append({"name": name, "state": state})
+        elif key == "gpu":
+            util, used, total, reasons = [field.strip() for field in value.split(",")]
+            gpus.append({"util": float(util), "mem": float(used) / float(total) * 100,
+                         "throttled": bool(int(reasons, 16) & GPU_THROTTLE_MASK)})
+        elif key == "ready":
+            try:
+                ready = json.loads(value)
+            except ValueError:
+                pass
+
+    first, last = snapshots[0], snapshots[-1]
+    elapsed = last["time"] - first["time"]
+
+    # user nice system idle iowait irq softirq steal
+    ticks = [b - a for a, b in zip(first["cpu"], last["cpu"])]
+    total = sum(ticks[:8]) or 1
+    idle = ticks[3] + ticks[4]
+    steal = ticks[7] if len(ticks) > 7 else 0
+
+    return {"time": last["time"],
+            "cpu": (total - idle - steal) / total * 100,
+            "steal": steal / total * 100,
+            "mem": (1 - mem["MemAvailable"] / mem["MemTotal"]) * 100,
+            "gpu_util": sum(gpu["util"] for gpu in gpus) / len(gpus) if gpus else None,
+            "gpu_mem": sum(gpu["mem"] for gpu in gpus) / len(gpus) if gpus else None,
+            "gpu_throttle": float(any(gpu["throttled"] for gpu in gpus)) if gpus else None,
+            "rx_mb_s": (last["net"][0] - first["net"][0]) / elapsed / 1e6,
+            "tx_mb_s": (last["net"][1] - first["net"][1]) / elapsed / 1e6,
+            "running": sum(container["state"] == "running" for container in containers),
+            "containers": containers,
+            "ready": ready}
+
+class RingBuffer:
+    """
+    Fixed-size buffer of timestamped samples backed by two arrays of doubles, which
+    overwrites its oldest samples once full.
+
+    :param int capacity: Number of samples kept
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array("d", bytes(8 * capacity))
+        self.values = array("d", bytes(8 * capacity))
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, t, value):
+        idx = self.count % self.capacity
+        self.times[idx] = t
+        self.values[idx] = value
+        self.count += 1
+
+    def items(self):
+        """
+        :return list: (time, value) samples, oldest first
+        """
+
+        start = self.count - len(self)
+        return [(self.times[i % self.capacity], self.values[i % self.capacity])
+                for i in range(start, self.count)]
+
+    def mean(self):
+        return math.fsum(self.values[i] for i in range(len(self))) / len(self) if len(self) else float("nan")
+
+# Polls the health of nodes in parallel
+class NodePoller:
+    """
+    :param list nodes: Nodes (dictionaries with rank, role and public_ip) to poll.
+        Nodes without a public IP are polled on this machine
+    :param str key: SSH private key for the nodes
+    :param str user: SSH user
+    :param float window: Seconds between the two counter snapshots of a poll
+    :param int max_workers: Maximum number of concurrent polls
+    """
+
+    def __init__(self, nodes, key=None, user="ubuntu", window=1.0, max_workers=32):
+        self.nodes = list(nodes)
+        self.key = key
+        self.user = user
+        self.probe = STATUS_PROBE.replace("WINDOW", str(window)).replace("READY_REPORT", READY_REPORT)
+        self.max_workers = max_workers
+
+    def poll_node(self, node):
+        """
+        :param dict node: Node
+        :return dict: Sample, or a dictionary with an error
+        """
+
+        if node.get("public_ip"):
+            cmd = ["ssh", "-i", self.key, "-o", "StrictHostKeyChecking=no", "-o", "ConnectTimeout=10",
+                   f"{self.user}@{node['public_ip']}", self.probe]
+        else:
+            cmd = ["sh", "-c", self.probe]
+
+        out = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        try:
+            return parse_status(out.stdout)
+        except (IndexError, KeyError, ValueError, ZeroDivisionError):
+            return {"time": time.time(), "error": out.stderr.strip() or "unparseable status"}
+
+    def poll(self):
+        """
+        :return dict: Mapping of rank -> sample
+        """
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(self.nodes)))) as pool:
+            return dict(zip([node["rank"] for node in self.nodes], pool.map(self.poll_node, self.nodes)))
+
+class MetricsCollector:
+    """
+    Polls the nodes every `interval` seconds in a background thread, keeping the last
+    `capacity` samples of each node and metric.
+
+    :param NodePoller poller: Poller of the nodes
+    :param float interval: Seconds between polls
+    :param int capacity: Samples kept per node and metric
+    """
+
+    def __init__(self, poller, interval=10.0, capacity=8640):
+        self.poller = poller
+        self.interval = interval
+        self.buffers = {node["rank"]: {metric: RingBuffer(capacity) for metric in METRICS}
+                        for node in poller.nodes}
+        self.latest = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, samples):
+        with self._lock:
+            for rank, sample in samples.items():
+                self.latest[rank] = sample
+                for metric in METRICS:
+                    if sample.get(metric) is not None:
+                        self.buffers[rank][metric].append(sample["time"], sample[metric])
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.time()
+            self.record(self.poller.poll())
+            self._stop.wait(max(0, self.interval - (time.time() - start)))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def rows(self):
+        """
+        :return list: (time, rank, metric, value) rows, ordered by node and metric
+        """
+
+        with self._lock:
+            return [(t, rank, metric, value)
+                    for rank, buffers in self.buffers.items()
+                    for metric, buf in buffers.items()
+                    for t, value in buf.items()]
+
+    def flags(self, idle=5.0, steal=10.0):
+        """
+        Flags nodes that were idle or throttled over the buffered window.
+
+        :param float idle: CPU and GPU utilization (%) under which a node is idle
+        :param float steal: CPU steal time (%) over which a node is throttled
+        :return dict: Mapping of rank -> list of flags
+        """
+
+        flags = {}
+        with self._lock:
+            for rank, buffers in self.buffers.items():
+                node_flags = []
+                gpu = buffers["gpu_util"]
+                if len(buffers["cpu"]) and buffers["cpu"].mean() < idle and (not len(gpu) or gpu.mean() < idle):
+                    node_flags.append("idle")
+                if (len(buffers["steal"]) and buffers["steal"].mean() > steal) or \
+                        (len(buffers["gpu_throttle"]) and buffers["gpu_throttle"].mean() > 0.5):
+                    node_flags.append("throttled")
+                flags[rank] = node_flags
+        return flags
+
+    def export(self, path):
+        """
+        Writes every buffered sample as time, rank, metric, value rows, to Parquet if the
+        path ends in .parquet (requires pyarrow) and to CSV otherwise.
+
+        :param str path: Output path
+        """
+
+        rows = self.rows()
+        if str(path).endswith(".parquet"):
+            if pyarrow is None:
+                raise RuntimeError("Parquet export requires pyarrow, export to .csv instead")
+            columns = list(zip(*rows)) or [[], [], [], []]
+            table = pyarrow.table({"time": pyarrow.array(columns[0], pyarrow.float64()),
+                                   "rank": pyarrow.array(columns[1], pyarrow.int32()),
+                                   "metric": pyarrow.array(columns[2], pyarrow.string()),
+                                   "value": pyarrow.array(columns[3], pyarrow.float64())})
+            pyarrow.parquet.write_table(table, str(path))
+        else:
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["time", "rank", "metric", "value"])
+                writer.writerows(rows)
+
+# Format one table row per node
+def format_status(nodes, samples, flags=None):
+    """
+    :param list nodes: Nodes polled
+    :param dict samples: Mapping of rank -> latest sample
+    :param dict flags: Mapping of rank -> list of flags
+    :return list: Lines of the status table
+    """
+
+    def pct(value):
+        return "-" if value is None else f"{value:.0f}%"
+
+    lines = [f"{'rank':>4}  {'role':<7} {'host':<16} {'containers':<11} {'ready':>6} {'cpu':>5} {'steal':>5} "
+             f"{'mem':>5} {'gpu':>5} {'gmem':>5} {'rx MB/s':>8} {'tx MB/s':>8}  flags"]
+    for node in nodes:
+        sample = samples.get(node["rank"], {})
+        host = node.get("public_ip") or "localhost"
+        if "error" in sample or not sample:
+            lines.append(f"{node['rank']:>4}  {node['role']:<7} {host:<16} {sample.get('error', 'no data')}")
+            continue
+        containers = f"{sample['running']}/{len(sample['containers'])}"
+        node_flags = list((flags or {}).get(node["rank"], []))
+        node_flags += [f"{c['name']} {c['state']}" for c in sample["containers"] if c["state"] != "running"]
+
+        # seconds from boot until init had the node's containers up
+        ready = sample.get("ready")
+        ready_s = "-" if ready is None else f"{ready['boot_to_ready']:.0f}s"
+        if ready is not None:
+            node_flags += [f"gave up waiting for {target}" for target, waited in ready.get("waits", {}).items()
+                           if waited is None]
+
+        lines.append(f"{node['rank']:>4}  {node['role']:<7} {host:<16} {containers:<11} {ready_s:>6} "
+                     f"{pct(sample['cpu']):>5} {pct(sample['steal']):>5} {pct(sample['mem']):>5} "
+                     f"{pct(sample['gpu_util']):>5} {pct(sample['gpu_mem']):>5} {sample['rx_mb_s']:>8.2f} {sample['tx_mb_s']:>8.2f}  "
+                     f"{', '.join(node_flags)}")
+    return lines
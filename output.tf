@@ -20,4 +20,20 @@ output "master-ssh" {
 
 output "notebook-login" {
     value = random_password.nb_password.result
-}
\ No newline at end of file
+}
+
+output "master_instance_id" {
+    value = aws_spot_instance_request.ec2-master.spot_instance_id
+}
+
+output "worker_instance_ids" {
+    value = data.aws_instances.cluster.ids
+}
+
+output "instance_type" {
+    value = var.instance_type
+}
+
+output "worker_asg_name" {
+    value = aws_autoscaling_group.ec2-cluster-asg.name
+}
@@ -0,0 +1,853 @@
+#!/usr/bin/env python3
+
+"""
+Node agent of Mars clusters, run by init.sh on every node from /opt/init.
+
+The agent treats config/<type>/<role>.json as the desired state of the node and
+reconciles its containers against it. Role-specific behavior is driven by that config:
+a mirror with "serve" set runs the registry mirror on the node (the master), any other
+enabled mirror is pulled through on the master, and images with a "layout" are sized
+to the node's hardware (the dask workers).
+"""
+
+import argparse
+import base64
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import shlex
+import shutil
+import socket
+import string
+import subprocess as sp
+import sys
+import time
+from datetime import datetime
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger("init")
+logger.setLevel(logging.INFO)
+
+# Labels identifying containers managed by init and the spec they were created from
+MANAGED_LABEL = "mars.managed"
+SPEC_LABEL    = "mars.spec"
+
+# On-disk cache of the ECR login token, shared by every run of init on the node
+ECR_CACHE = "/var/cache/mars/ecr_token.json"
+
+class Tracer:
+    """
+    Records timed spans of the node init phases, exported as a Chrome trace so the
+    launcher can merge them into its own launch trace.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            self.events.append({"name": name, "cat": "init", "ph": "X", "ts": start * 1e6,
+                                "dur": (end - start) * 1e6, "pid": 0, "tid": 0, "args": args})
+            logger.info(f"=> {name} took {end - start:.2f}s")
+
+    def total(self, name):
+        return sum(ev["dur"] for ev in self.events if ev["name"] == name) / 1e6
+
+    def dump(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events}, f)
+
+def ecr_login(credentials, docker="docker", aws="~/.local/bin/aws", cache_path=ECR_CACHE, margin=1800):
+    """
+    Logs docker into the account's ECR registry. The authorization token is cached on
+    disk until `margin` seconds before it expires, so re-runs of init neither call the
+    AWS API nor log in again. Concurrent calls on a node are serialized on a lock file,
+    and those that waited reuse the token fetched by the first.
+
+    :param dict credentials: AWS credentials environment
+    :param str docker: Docker executable
+    :param str aws: AWS CLI executable
+    :param str cache_path: Path of the token cache
+    :param float margin: Seconds before expiry at which the token is refreshed
+    :return dict: Token, with keys endpoint, username, password and expires_at, or None
+        if none could be fetched
+    """
+
+    key = {"access_key": credentials.get("AWS_ACCESS_KEY_ID"), "region": credentials.get("AWS_DEFAULT_REGION")}
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+
+    with open(f"{cache_path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        token = None
+        if os.path.isfile(cache_path):
+            with open(cache_path, "r") as f:
+                token = json.load(f)
+            if token.get("key") != key or token["expires_at"] - margin < time.time():
+                token = None
+
+        if token is None:
+            out = sp.run([os.path.expanduser(aws), "ecr", "get-authorization-token", "--output", "json"],
+                         env=dict(os.environ, **credentials), stdout=sp.PIPE, universal_newlines=True)
+            if out.returncode != 0:
+                logger.warning("=> Could not get an ECR authorization token")
+                return None
+
+            auth = json.loads(out.stdout)["authorizationData"][0]
+            username, _, password = base64.b64decode(auth["authorizationToken"]).decode().partition(":")
+            expires_at = auth["expiresAt"]
+            if isinstance(expires_at, str):
+                expires_at = datetime.fromisoformat(expires_at.replace("Z", "+00:00")).timestamp()
+
+            token = {"key": key,
+                     "endpoint": auth["proxyEndpoint"],
+                     "username": username,
+                     "password": password,
+                     "expires_at": float(expires_at),
+                     "logged_in": False}
+
+        if not token["logged_in"]:
+            login = sp.run([docker, "login", "--username", token["username"], "--password-stdin", token["endpoint"]],
+                           input=token["password"], stdout=sp.DEVNULL, universal_newlines=True)
+            token["logged_in"] = login.returncode == 0
+            if not token["logged_in"]:
+                logger.warning(f"=> Could not log docker into {token['endpoint']}")
+
+            tmp_path = f"{cache_path}.tmp"
+            with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+                json.dump(token, f)
+            os.replace(tmp_path, cache_path)
+        else:
+            logger.info(f"=> Reusing ECR login, valid for {(token['expires_at'] - time.time()) / 3600:.1f}h")
+
+    return token
+
+def pull_images(images, docker="docker", max_parallel=4, tracer=None, resolve=None):
+    """
+    Pulls every distinct image concurrently, so no container start waits on a pull.
+
+    :param list images: Image names, possibly repeated
+    :param str docker: Docker executable
+    :param int max_parallel: Maximum number of concurrent pulls
+    :param Tracer tracer: Records the time spent pulling each image
+    :param callable resolve: Returns alternate references (e.g. on a mirror) to try
+        before the image itself. A successful alternate is tagged as the image
+    :return dict: Mapping of image -> exit status of docker pull
+    """
+
+    tracer = tracer or Tracer()
+    images = list(dict.fromkeys(images))
+
+    def pull(image):
+        with tracer.span(f"docker_pull:{image}"):
+            for ref in (resolve(image) if resolve else []):
+                if sp.run([docker, "pull", "-q", ref], stdout=sp.DEVNULL).returncode == 0:
+                    return sp.run([docker, "tag", ref, image]).returncode
+                logger.warning(f"=> Could not pull {ref}, falling back to {image}")
+            return sp.run([docker, "pull", "-q", image], stdout=sp.DEVNULL).returncode
+
+    if not images:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(images)))) as pool:
+        return dict(zip(images, pool.map(pull, images)))
+
+def start_order(images):
+    """
+    Orders image configs so each comes after the containers listed in its "depends_on".
+
+    :param list images: Image configs
+    :return list: Image configs in dependency order
+    """
+
+    by_name = {img["name"]: img for img in images}
+    ordered, visiting = [], set()
+
+    def visit(img):
+        if img in ordered:
+            return
+        if img["name"] in visiting:
+            raise ValueError(f"Dependency cycle through container {img['name']}")
+        visiting.add(img["name"])
+        for dep in img.get("depends_on", []):
+            if dep not in by_name:
+                raise ValueError(f"Container {img['name']} depends on unknown container {dep}")
+            visit(by_name[dep])
+        visiting.discard(img["name"])
+        ordered.append(img)
+
+    for img in images:
+        visit(img)
+    return ordered
+
+def wait_for_port(host, port, timeout=600, initial_delay=0.5, max_delay=15, tracer=None):
+    """
+    Waits for a TCP listener on host:port, retrying with jittered exponential backoff
+    until the deadline.
+
+    :param str host: Host to probe
+    :param int port: Port to probe
+    :param float timeout: Seconds before giving up
+    :param float initial_delay: Delay before the first retry, doubled on each retry
+    :param float max_delay: Upper bound of the delay between retries
+    :param Tracer tracer: Records the time spent waiting
+    :return float: Seconds waited, or None if the deadline passed
+    """
+
+    tracer = tracer or Tracer()
+    start = time.time()
+    deadline = start + timeout
+    attempt = 0
+
+    with tracer.span(f"wait:{host}:{port}"):
+        while True:
+            try:
+                with socket.create_connection((host, port), timeout=min(5, max_delay)):
+                    return time.time() - start
+            except OSError:
+                pass
+
+            delay = min(max_delay, initial_delay * 2 ** attempt) * (0.5 + random.random() / 2)
+            if time.time() + delay > deadline:
+                logger.warning(f"=> {host}:{port} not up after {time.time() - start:.0f}s")
+                return None
+            attempt += 1
+            time.sleep(delay)
+
+def publish_ready(path, role, init_start, waits):
+    """
+    Writes the node's time-to-ready, measured from boot and from the start of init.
+
+    :param str path: Output path of the JSON report
+    :param str role: Role of node
+    :param float init_start: Time (seconds since epoch) init started
+    :param dict waits: Mapping of awaited host:port -> seconds waited (None on timeout)
+    :return dict: The report
+    """
+
+    with open("/proc/uptime", "r") as f:
+        uptime = float(f.read().split()[0])
+
+    now = time.time()
+    report = {"host": socket.gethostname(),
+              "role": role,
+              "ready_at": now,
+              "boot_to_ready": uptime,
+              "init_to_ready": now - init_start,
+              "waits": waits}
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    logger.info(f"=> Node ready {report['boot_to_ready']:.1f}s after boot "
+                f"({report['init_to_ready']:.1f}s after init started)")
+    return report
+
+def wait_ready(img_config, docker="docker", poll=0.5):
+    """
+    Blocks until a started container passes its readiness check. The image config's
+    "ready" entry selects the check: {"port": N} waits for a TCP listener on the host
+    network, {"cmd": "..."} for the command to succeed inside the container, and by
+    default the container only has to be running.
+
+    :param dict img_config: Image config
+    :param str docker: Docker executable
+    :param float poll: Seconds between checks
+    :return bool: Whether the container became ready before the timeout
+    """
+
+    ready = img_config.get("ready", {})
+    name = img_config["name"]
+    deadline = time.time() + float(ready.get("timeout", 60))
+
+    while time.time() < deadline:
+        if "port" in ready:
+            try:
+                with socket.create_connection((ready.get("host", "127.0.0.1"), int(ready["port"])), timeout=poll):
+                    return True
+            except OSError:
+                pass
+        elif "cmd" in ready:
+            if sp.run([docker, "exec", name, "sh", "-c", ready["cmd"]],
+                      stdout=sp.DEVNULL, stderr=sp.DEVNULL).returncode == 0:
+                return True
+        else:
+            state = sp.run([docker, "inspect", "-f", "{{.State.Running}}", name],
+                           stdout=sp.PIPE, stderr=sp.DEVNULL, universal_newlines=True)
+            if state.stdout.strip() == "true":
+                return True
+        time.sleep(poll)
+
+    logger.warning(f"=> Container {name} not ready after {ready.get('timeout', 60)}s")
+    return False
+
+def registry_host(image):
+    """
+    :param str image: Image reference
+    :return str: Registry host serving the image (docker.io for Docker Hub)
+    """
+
+    first, _, rest = image.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        return first
+    return "docker.io"
+
+def mirror_refs(image, mirror, mirror_host):
+    """
+    References of an image on the master's registry mirror. Docker Hub images need
+    none, as dockerd itself is pointed at the Hub mirror (see configure_docker_mirror).
+
+    :param str image: Image reference
+    :param dict mirror: Mirror config, with a list of {"port", "remote"} upstreams
+    :param str mirror_host: Address of the node hosting the mirror
+    :return list: Mirror references of the image
+    """
+
+    host = registry_host(image)
+    if host == "docker.io":
+        return []
+    return [f"{mirror_host}:{upstream['port']}/{image.partition('/')[2]}"
+            for upstream in mirror["upstreams"] if urlparse(upstream["remote"]).netloc == host]
+
+def configure_docker_mirror(mirror, mirror_host, daemon_config="/etc/docker/daemon.json", docker="docker"):
+    """
+    Points dockerd at the registry mirror: the Docker Hub upstream becomes a
+    registry-mirror (dockerd falls back to the Hub if it is unreachable) and every
+    mirror port is allowed over plain HTTP, which stays inside the subnet.
+
+    :param dict mirror: Mirror config
+    :param str mirror_host: Address of the node hosting the mirror
+    :param str daemon_config: Path of dockerd's config file
+    :param str docker: Docker executable
+    """
+
+    daemon = {}
+    if os.path.isfile(daemon_config):
+        with open(daemon_config, "r") as f:
+            daemon = json.load(f)
+
+    wanted = dict(daemon)
+    hub = [f"http://{mirror_host}:{up['port']}" for up in mirror["upstreams"] if "docker.io" in up["remote"]]
+    wanted["registry-mirrors"] = list(dict.fromkeys(hub + daemon.get("registry-mirrors", [])))
+    wanted["insecure-registries"] = list(dict.fromkeys(
+        [f"{mirror_host}:{up['port']}" for up in mirror["upstreams"]] + daemon.get("insecure-registries", [])))
+
+    if wanted == daemon:
+        return
+
+    os.makedirs(os.path.dirname(daemon_config), exist_ok=True)
+    with open(daemon_config, "w") as f:
+        json.dump(wanted, f, indent=2)
+
+    logger.info("=> Restarting docker to use the registry mirror...")
+    sp.run(["systemctl", "restart", "docker"])
+    deadline = time.time() + 60
+    while sp.run([docker, "info"], stdout=sp.DEVNULL, stderr=sp.DEVNULL).returncode != 0:
+        if time.time() > deadline:
+            raise RuntimeError("docker did not come back after enabling the registry mirror")
+        time.sleep(1)
+
+def start_mirror(mirror, ecr_token=None, docker="docker", tracer=None):
+    """
+    Runs a pull-through registry cache on the master for every upstream of the mirror
+    config. The cache fills on first pull and is served to the workers over the
+    subnet. Unchanged mirrors are left running across re-runs of init. ECR upstreams
+    ({"ecr": true}) authenticate with the cached ECR login token, so their mirror is
+    recreated whenever init runs after the token was refreshed.
+
+    :param dict mirror: Mirror config
+    :param dict ecr_token: ECR login token, from ecr_login
+    :param str docker: Docker executable
+    :param Tracer tracer: Records the time spent starting the mirror
+    """
+
+    tracer = tracer or Tracer()
+    storage = mirror.get("storage", "/var/lib/mars-mirror")
+
+    image = mirror.get("image", "registry:2")
+    if image_id(image, docker=docker) is None:
+        sp.run([docker, "pull", "-q", image], stdout=sp.DEVNULL)
+
+    keep = set()
+    for upstream in mirror["upstreams"]:
+        port = int(upstream["port"])
+        name = f"mars-mirror-{port}"
+        env = {"REGISTRY_HTTP_ADDR": f"0.0.0.0:{port}",
+               "REGISTRY_PROXY_REMOTEURL": upstream["remote"]}
+
+        if upstream.get("ecr") and ecr_token is not None:
+            env.update({"REGISTRY_PROXY_USERNAME": ecr_token["username"],
+                        "REGISTRY_PROXY_PASSWORD": ecr_token["password"]})
+
+        spec = container_spec(name, image, env=env, docker=docker,
+                              options=["--restart", "always", "-v", f"{storage}/{port}:/var/lib/registry"])
+
+        with tracer.span(f"mirror:{port}", remote=upstream["remote"]):
+            # workers pull from the origin when the mirror is down, so init carries on
+            try:
+                logger.info(f"=> Mirror {name}: {reconcile_container(spec, group='mirror', docker=docker)}")
+            except RuntimeError as e:
+                logger.warning(f"=> {e}")
+                continue
+            wait_ready({"name": name, "ready": {"port": port, "timeout": 60}}, docker=docker)
+        keep.add(name)
+
+    prune_containers(keep, group="mirror", docker=docker)
+
+def expand_vars(value, env=None):
+    """
+    Expands $VAR and ${VAR} references, as a shell would for the arguments of a
+    container command. Unknown variables are left as they are.
+
+    :param str value: String to expand
+    :param dict env: Variables to expand from. Defaults to the environment
+    :return str: Expanded string
+    """
+
+    expanded = string.Template(value).safe_substitute(os.environ if env is None else env)
+    for var in re.findall(r"\$\{?(\w+)", expanded):
+        logger.warning(f"=> ${var} is not set, leaving it unexpanded")
+    return expanded
+
+def image_id(image, docker="docker"):
+    """
+    :param str image: Image reference
+    :param str docker: Docker executable
+    :return str: Content digest of the local copy of the image, or None if absent
+    """
+
+    out = sp.run([docker, "image", "inspect", "-f", "{{.Id}}", image],
+                 stdout=sp.PIPE, stderr=sp.DEVNULL, universal_newlines=True)
+    return out.stdout.strip() if out.returncode == 0 else None
+
+def container_spec(name, image, command=(), env=None, options=(), docker="docker"):
+    """
+    Desired state of a container. Its hash covers the image digest, the command, the
+    environment and the docker run options, and is stored as a label on the container
+    so a re-run can tell whether it needs recreating.
+
+    :param str name: Container name
+    :param str image: Image reference
+    :param list command: Command arguments, already expanded
+    :param dict env: Container environment
+    :param list options: Extra docker run options
+    :param str docker: Docker executable
+    :return dict: Container spec
+    """
+
+    spec = {"name": name,
+            "image": image,
+            "image_id": image_id(image, docker=docker),
+            "command": list(command),
+            "env": {var: str(val) for var, val in (env or {}).items()},
+            "options": list(options)}
+    spec["hash"] = hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+    return spec
+
+def container_state(name, docker="docker"):
+    """
+    :param str name: Container name
+    :param str docker: Docker executable
+    :return tuple: Spec hash label and whether the container is running, or None if
+        there is no such container. The hash is empty for containers without the label,
+        such as those started before labels were used, so they are always recreated
+    """
+
+    out = sp.run([docker, "inspect", "-f", f'{{{{index .Config.Labels "{SPEC_LABEL}"}}}} {{{{.State.Running}}}}', name],
+                 stdout=sp.PIPE, stderr=sp.DEVNULL, universal_newlines=True)
+    if out.returncode != 0:
+        return None
+    spec_hash, _, running = out.stdout.strip("\n").rpartition(" ")
+    if spec_hash.strip() in ("", "<no value>"):
+        spec_hash = ""
+    return spec_hash, running == "true"
+
+def reconcile_container(spec, group="images", docker="docker"):
+    """
+    Brings a container to its spec: a running container with the same spec hash is left
+    alone, a stopped one is started again, and anything else is (re)created. Raises
+    RuntimeError with docker's error if the container could not be created.
+
+    :param dict spec: Container spec, from container_spec
+    :param str group: Group of managed containers the container belongs to
+    :param str docker: Docker executable
+    :return str: Action taken: unchanged, restarted, created or recreated
+    """
+
+    name = spec["name"]
+    current = container_state(name, docker=docker)
+
+    if current is not None:
+        spec_hash, running = current
+        if spec_hash == spec["hash"]:
+            if running:
+                return "unchanged"
+            if sp.run([docker, "start", name], stdout=sp.DEVNULL).returncode == 0:
+                return "restarted"
+        sp.run([docker, "rm", "-f", name], stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+
+    cmd = [docker, "run", "-d", "--network", "host", "--name", name,
+           "--label", f"{MANAGED_LABEL}={group}", "--label", f"{SPEC_LABEL}={spec['hash']}"]
+    cmd += spec["options"]
+    for var, val in spec["env"].items():
+        cmd += ["-e", f"{var}={val}"]
+    cmd.append(spec["image"])
+    cmd += spec["command"]
+
+    out = sp.run(cmd, stdout=sp.DEVNULL, stderr=sp.PIPE, universal_newlines=True)
+    if out.returncode != 0:
+        raise RuntimeError(f"Could not create container {name}: {out.stderr.strip()}")
+    return "created" if current is None else "recreated"
+
+def prune_containers(keep, group="images", docker="docker"):
+    """
+    Removes the managed containers of a group that are no longer in the config.
+
+    :param set keep: Names of containers to keep
+    :param str group: Group of managed containers
+    :param str docker: Docker executable
+    :return list: Names of removed containers
+    """
+
+    out = sp.run([docker, "ps", "-a", "--filter", f"label={MANAGED_LABEL}={group}", "--format", "{{.Names}}"],
+                 stdout=sp.PIPE, stderr=sp.DEVNULL, universal_newlines=True)
+    removed = [name for name in out.stdout.split() if name not in keep]
+    for name in removed:
+        logger.info(f"=> Removing container {name}, which is no longer configured")
+        sp.run([docker, "rm", "-f", name], stdout=sp.DEVNULL)
+    return removed
+
+def parse_cpulist(cpulist):
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        lo, _, hi = part.partition("-")
+        cpus.extend(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+def format_cpulist(cpus):
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(lo) if lo == hi else f"{lo}-{hi}" for lo, hi in ranges)
+
+def instance_store_dirs(mount_root="/mnt", format_disks=False):
+    """
+    Mount points of the instance's local NVMe (instance store) disks. Disks that are not
+    mounted yet are mounted under mount_root. Disks holding no filesystem are skipped,
+    unless formatting is enabled in the node config ("instance_store": {"format": true}),
+    as mkfs erases whatever blkid does not recognize.
+
+    :param str mount_root: Directory under which unmounted disks are mounted
+    :param bool format_disks: Format disks that hold no filesystem
+    :return list: Mount points
+    """
+
+    with open("/proc/mounts", "r") as f:
+        mounts = {line.split()[0]: line.split()[1] for line in f}
+
+    dirs = []
+    for block in sorted(glob.glob("/sys/block/nvme*n1")):
+        try:
+            with open(os.path.join(block, "device", "model"), "r") as f:
+                model = f.read().strip()
+        except OSError:
+            continue
+        if "Instance Storage" not in model:
+            continue
+
+        dev = f"/dev/{os.path.basename(block)}"
+        if dev not in mounts:
+            mountpoint = os.path.join(mount_root, f"mars-{os.path.basename(block)}")
+            if sp.run(["blkid", dev], stdout=sp.DEVNULL).returncode != 0:
+                if not format_disks:
+                    logger.info(f"=> Instance store {dev} holds no filesystem and formatting is off, skipping it")
+                    continue
+                # without -F, mkfs refuses rather than prompts when it finds data
+                if sp.run(["mkfs.ext4", "-q", dev], stdin=sp.DEVNULL).returncode != 0:
+                    logger.warning(f"=> Could not format instance store {dev}")
+                    continue
+            os.makedirs(mountpoint, exist_ok=True)
+            if sp.run(["mount", dev, mountpoint]).returncode != 0:
+                logger.warning(f"=> Could not mount instance store {dev}")
+                continue
+            mounts[dev] = mountpoint
+        dirs.append(mounts[dev])
+    return dirs
+
+def probe_hardware(instance_store=None):
+    """
+    :param dict instance_store: Instance store config, with keys mount_root and format
+    :return dict: Hardware of this node, with keys cpus (usable CPU ids), memory (bytes),
+        numa (NUMA node -> CPU ids) and disks (instance store mount points)
+    """
+
+    instance_store = instance_store or {}
+
+    cpus = sorted(os.sched_getaffinity(0))
+
+    with open("/proc/meminfo", "r") as f:
+        memory = next(int(line.split()[1]) * 1024 for line in f if line.startswith("MemTotal:"))
+
+    numa = {}
+    for node in glob.glob("/sys/devices/system/node/node[0-9]*"):
+        with open(os.path.join(node, "cpulist"), "r") as f:
+            node_cpus = [cpu for cpu in parse_cpulist(f.read()) if cpu in cpus]
+        if node_cpus:
+            numa[int(os.path.basename(node)[4:])] = node_cpus
+
+    return {"cpus": cpus,
+            "memory": memory,
+            "numa": dict(sorted(numa.items())) or {0: cpus},
+            "disks": instance_store_dirs(instance_store.get("mount_root", "/mnt"),
+                                         format_disks=bool(instance_store.get("format", False)))}
+
+def worker_layout(hw, layout=None):
+    """
+    Splits the node into dask-worker groups, one per NUMA node (or a single group if
+    pinning is off). Each group runs as many worker processes as fit its CPUs at
+    `nthreads` threads each, and the node's memory, less a reserve for the OS, is
+    divided evenly between all processes. Spill directories are spread over the
+    instance store disks.
+
+    Every choice can be overridden in the layout config: numa (bool), nworkers (total
+    over the node), nthreads, memory_limit (bytes or a dask size string),
+    memory_reserve (fraction) and local_directory (list of paths, or false).
+
+    :param dict hw: Hardware of the node, from probe_hardware
+    :param dict layout: Layout config
+    :return list: Worker groups, with keys cpus, mems, nworkers, nthreads,
+        memory_limit and local_directory
+    """
+
+    layout = layout or {}
+    if layout.get("numa", True):
+        groups = [{"cpus": cpus, "mems": node} for node, cpus in hw["numa"].items()]
+    else:
+        groups = [{"cpus": hw["cpus"], "mems": None}]
+
+    # processes x threads within each group
+    total = layout.get("nworkers")
+    for idx, group in enumerate(groups):
+        group["nthreads"] = int(layout.get("nthreads", min(4, len(group["cpus"]))))
+        if total:
+            share, extra = divmod(int(total), len(groups))
+            group["nworkers"] = max(1, share + (idx < extra))
+        else:
+            group["nworkers"] = max(1, len(group["cpus"]) // group["nthreads"])
+
+    # even split of memory over processes, keeping a reserve for the OS and docker
+    nworkers = sum(group["nworkers"] for group in groups)
+    memory_limit = layout.get("memory_limit",
+                              int(hw["memory"] * (1 - float(layout.get("memory_reserve", 0.1))) / nworkers))
+
+    spill = layout.get("local_directory", hw["disks"]) or []
+    for idx, group in enumerate(groups):
+        group["memory_limit"] = memory_limit
+        group["local_directory"] = spill[idx % len(spill)] if spill else None
+
+    return groups
+
+def expand_layout(img_config, hw):
+    """
+    Expands a dask-worker image config with a "layout" entry into one container per
+    worker group, pinned to the group's CPUs and memory node.
+
+    :param dict img_config: Image config
+    :param dict hw: Hardware of the node, from probe_hardware
+    :return list: Image configs
+    """
+
+    groups = worker_layout(hw, img_config["layout"])
+    configs = []
+    for idx, group in enumerate(groups):
+        config = dict(img_config)
+        config.pop("layout")
+        if len(groups) > 1:
+            config["name"] = f"{img_config['name']}-{idx}"
+
+        config["command"] = (f"{img_config['command']} --nworkers {group['nworkers']} "
+                             f"--nthreads {group['nthreads']} --memory-limit {group['memory_limit']}")
+        options = list(img_config.get("run_options", []))
+        if group["mems"] is not None:
+            options += ["--cpuset-cpus", format_cpulist(group["cpus"]), "--cpuset-mems", str(group["mems"])]
+        if group["local_directory"]:
+            options += ["-v", f"{group['local_directory']}/dask-{idx}:/scratch"]
+            config["command"] += " --local-directory /scratch"
+        config["run_options"] = options
+
+        logger.info(f"=> {config['name']}: {group['nworkers']} workers x {group['nthreads']} threads, "
+                    f"{group['memory_limit']} bytes each, CPUs {format_cpulist(group['cpus'])}, "
+                    f"spilling to {group['local_directory'] or 'the container'}")
+        configs.append(config)
+    return configs
+
+def run_docker_cmd(config, gpu=False, num_gpus=0, nb_pass=None, tracer=None, docker="docker",
+                   max_pulls=4, resolve=None, aws="~/.local/bin/aws", ecr_cache=ECR_CACHE):
+    tracer = tracer or Tracer()
+
+    # log into ECR
+    with tracer.span("ecr_login"):
+        ecr_login(config["credentials"], docker=docker, aws=aws, cache_path=ecr_cache)
+
+    # pull every image up front, in parallel
+    with tracer.span("pull"):
+        pulled = pull_images([str(img["image"]) for img in config["images"]],
+                             docker=docker, max_parallel=max_pulls, tracer=tracer, resolve=resolve)
+    for image, code in pulled.items():
+        if code != 0:
+            logger.warning(f"=> Failed to pull {image}, docker run will retry")
+
+    # reconcile containers against the config, in dependency order
+    start = time.time()
+    ready = {}
+    waits = {}
+    actions = {}
+    for img_config in start_order(config["images"]):
+        name = img_config["name"]
+        for dep in img_config.get("depends_on", []):
+            if not ready[dep]:
+                logger.warning(f"=> Starting {name} although {dep} is not ready")
+
+        env = dict(config["env"])
+        if gpu:
+            env["NUM_GPUS"] = num_gpus
+
+        # if notebook image, set password
+        if "notebook" in img_config and bool(img_config["notebook"]):
+            env["JUPYTER_PASSWORD"] = nb_pass
+
+        # commands are passed to docker as arguments, so no shell expands them
+        command = [expand_vars(arg) for arg in shlex.split(str(img_config.get("command", "")))]
+        spec = container_spec(name, str(img_config["image"]), command=command, env=env,
+                              options=["-it"] + (["--gpus", "all"] if gpu else []) + img_config.get("run_options", []),
+                              docker=docker)
+
+        with tracer.span(f"docker_run:{name}", image=spec["image"]):
+            current = container_state(name, docker=docker)
+
+            # services on other nodes, e.g. the scheduler on the master
+            if current is None or current[0] != spec["hash"]:
+                for target in img_config.get("wait_for", []):
+                    host = expand_vars(str(target["host"]))
+                    port = int(target["port"])
+                    logger.info(f"=> Waiting for {host}:{port} before starting {name}...")
+                    waits[f"{host}:{port}"] = wait_for_port(host, port, timeout=float(target.get("timeout", 600)),
+                                                            tracer=tracer)
+
+            actions[name] = reconcile_container(spec, docker=docker)
+            logger.info(f"=> Container {name}: {actions[name]}")
+            ready[name] = wait_ready(img_config, docker=docker)
+
+    prune_containers(set(ready), docker=docker)
+
+    counts = ", ".join(f"{sum(a == action for a in actions.values())} {action}"
+                       for action in dict.fromkeys(actions.values()))
+    logger.info(f"=> Pulled {len(pulled)} images in {tracer.total('pull'):.2f}s, "
+                f"reconciled {len(ready)} containers ({counts}) in {time.time() - start:.2f}s")
+
+    return waits
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--aws-access-key", type=str, required=True, help="AWS access key")
+    parser.add_argument("--aws-secret-key", type=str, required=True, help="AWS secret key")
+    parser.add_argument("--aws-default-region", type=str, default="us-east-1", help="AWS default region")
+    parser.add_argument("--gpu", type=int, default=0, help="GPU instance?")
+    parser.add_argument("--num-gpus", type=int, default=0, help="Number of GPUs on EC2 instance")
+    parser.add_argument("--nb-pass", type=str, default=None, help="Jupyter notebook password")
+    parser.add_argument("--role", type=str, required=True, help="Role-- master or worker?")
+    parser.add_argument("--docker", type=str, default="docker", help="Docker executable")
+    parser.add_argument("--aws", type=str, default="~/.local/bin/aws", help="AWS CLI executable")
+    parser.add_argument("--ecr-cache", type=str, default=ECR_CACHE, help="Path where the ECR login token is cached")
+    parser.add_argument("--max-pulls", type=int, default=4, help="Maximum number of concurrent image pulls")
+    parser.add_argument("--ready-report", type=str, default="/var/log/mars/ready.json", help="Path where the node's time-to-ready is written")
+    parser.add_argument("--trace", type=str, default="/var/log/mars/init_trace.json", help="Path where init phase timings are written")
+    parser.add_argument("--config-path", type=str, default="/opt/config/", help="Directory of the role configs")
+    parser.add_argument("--artifacts-path", type=str, default="/opt/artifacts/", help="Directory of the cluster artifacts")
+
+    args = parser.parse_args()
+    init_start = time.time()
+    logging.basicConfig(level=logging.INFO)
+    logger.info(f"Initializing {args.role} node...")
+
+    ### Initialize
+    # Extract config JSON -> dict
+    with open(os.path.abspath(os.path.join(args.config_path, f"{args.role}.json")), "r") as f:
+        config = json.load(f)
+
+    # Get master address, shipped to every node but the master itself
+    master_private = os.path.join(args.artifacts_path, "master_private.txt")
+    if os.path.isfile(master_private):
+        with open(master_private, "r") as f:
+            os.environ["MASTER_ADDR"] = str(f.read()).strip().strip("\"")
+
+    # Set Jupyter notebook pass variable
+    if args.nb_pass is not None:
+        os.environ["JUPYTER_PASSWORD"] = args.nb_pass
+
+    # Set environment variables
+    logger.info("=> Setting environment variables...")
+    for var, value in config["env"].items():
+        os.environ[var] = str(value)
+
+    config["credentials"] = {"AWS_ACCESS_KEY_ID": args.aws_access_key,
+                             "AWS_SECRET_ACCESS_KEY": args.aws_secret_key,
+                             "AWS_DEFAULT_REGION": args.aws_default_region}
+
+    # Load docker images
+    if isinstance(config["images"], dict):
+        config["images"] = [config["images"]]
+
+    # Size dask-worker processes, threads and memory to the node
+    if any("layout" in img for img in config["images"]):
+        hw = probe_hardware(config.get("instance_store"))
+        logger.info(f"=> {len(hw['cpus'])} CPUs, {hw['memory'] / 2**30:.1f} GiB memory, "
+                    f"{len(hw['numa'])} NUMA nodes, {len(hw['disks'])} instance store disks")
+        config["images"] = [cfg for img in config["images"]
+                            for cfg in (expand_layout(img, hw) if "layout" in img else [img])]
+
+    tracer = Tracer()
+
+    # Serve images from a pull-through cache on this node, or pull through the master's
+    resolve = None
+    mirror = config.get("mirror", {})
+    if mirror.get("enabled") and mirror.get("serve"):
+        logger.info("=> Starting registry mirror...")
+        ecr_token = None
+        if any(upstream.get("ecr") for upstream in mirror["upstreams"]):
+            ecr_token = ecr_login(config["credentials"], docker=args.docker, aws=args.aws, cache_path=args.ecr_cache)
+        start_mirror(mirror, ecr_token, docker=args.docker, tracer=tracer)
+        configure_docker_mirror(mirror, "127.0.0.1", docker=args.docker)
+        resolve = lambda image: mirror_refs(image, mirror, "127.0.0.1")
+    elif mirror.get("enabled") and os.environ.get("MASTER_ADDR"):
+        logger.info(f"=> Using registry mirror on {os.environ['MASTER_ADDR']}...")
+        configure_docker_mirror(mirror, os.environ["MASTER_ADDR"], docker=args.docker)
+        resolve = lambda image: mirror_refs(image, mirror, os.environ["MASTER_ADDR"])
+
+    waits = run_docker_cmd(config, gpu=args.gpu, num_gpus=args.num_gpus, nb_pass=args.nb_pass, tracer=tracer,
+                           docker=args.docker, max_pulls=args.max_pulls, resolve=resolve,
+                           aws=args.aws, ecr_cache=args.ecr_cache)
+    tracer.dump(args.trace)
+    publish_ready(args.ready_report, args.role, init_start, waits)
+
+
+if __name__ == "__main__":
+    main()
@@ -44,6 +44,7 @@ fi
 
 # Create terraform artifacts
 echo "Creating terraform artifacts..."
+terraform output -json > ./artifacts/terraform_output.json
 echo "[master]" > ./ansible/inventory
 terraform output -json | jq -r '.master_public_ip.value + " ansible_user=ubuntu"' >> ./ansible/inventory
 echo -e "\n[workers]" >> ./ansible/inventory
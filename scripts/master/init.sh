@@ -44,7 +44,7 @@ echo "Setting permissions on docker..."
 sudo chown ubuntu:ubuntu /home/ubuntu/.docker -R
 
 echo "Running initialization script..."
-python3 /opt/init/start.py \
+python3 /opt/init/agent.py \
     --aws-access-key ${AWS_ACCESS_KEY} \
     --aws-secret-key ${AWS_SECRET_KEY} \
     --aws-default-region ${AWS_REGION} \
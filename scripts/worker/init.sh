@@ -52,7 +52,7 @@ if [ -d "/home/ubuntu/.docker/" ]; then
 fi
 
 echo "Running initialization script..."
-python3 /opt/init/start.py \
+python3 /opt/init/agent.py \
     --aws-access-key ${AWS_ACCESS_KEY} \
     --aws-secret-key ${AWS_SECRET_KEY} \
     --aws-default-region ${AWS_REGION} \
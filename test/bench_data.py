@@ -0,0 +1,39 @@
+import argparse
+import logging
+
+import torch
+
+from torch.utils.data import DataLoader
+
+from utils import MemmapLoader, benchmark_loader, cache_CIFAR10_data, get_CIFAR10_data
+
+logger = logging.getLogger("bench_data")
+logger.setLevel(logging.INFO)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the images/sec of the CIFAR10 input pipelines")
+    parser.add_argument("-d", "--data", type=str, default="data/", help="Path to folder where data is stored/downloaded")
+    parser.add_argument("--n-workers", type=int, default=4, help="Number of workers for dataloader")
+    parser.add_argument("--batch-size", type=int, default=128, help="Batch size for input")
+    parser.add_argument("--batches", type=int, default=100, help="Number of batches timed per pipeline")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    # PIL transforms on every sample, in DataLoader workers
+    dloader = DataLoader(dataset=get_CIFAR10_data(args.data),
+                         batch_size=args.batch_size,
+                         shuffle=True,
+                         num_workers=args.n_workers,
+                         pin_memory=True,
+                         drop_last=True)
+    transform_rate = benchmark_loader(dloader, args.batches, device)
+    logger.info(f"Transforms:   {transform_rate:10.0f} images/s ({args.n_workers} workers)")
+
+    # Preprocessed once, memory-mapped and normalized on the device
+    images, labels = cache_CIFAR10_data(args.data)
+    mloader = MemmapLoader(images, labels, args.batch_size, device, mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5))
+    cache_rate = benchmark_loader(mloader, min(args.batches, len(mloader) - 1), device)
+    logger.info(f"Memory-mapped: {cache_rate:10.0f} images/s ({cache_rate / transform_rate:.1f}x)")
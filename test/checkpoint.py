@@ -0,0 +1,160 @@
+import glob
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+"""
+Asynchronous checkpointing of the training state to local disk
+"""
+
+logger = logging.getLogger("dcgan")
+
+
+# Find the most recent checkpoint in a directory
+def latest_checkpoint(directory):
+    """
+    :param str directory: Checkpoint directory
+    :return str: Path of the latest checkpoint, or None if there is none
+    """
+
+    paths = sorted(glob.glob(os.path.join(directory, "ckpt-*.pt")))
+    return paths[-1] if paths else None
+
+# Iteration a checkpoint was saved at
+def checkpoint_iteration(path):
+    """
+    :param str path: Path of a checkpoint saved by AsyncCheckpointer
+    :return int: Training iteration of the checkpoint
+    """
+
+    return int(os.path.basename(path)[len("ckpt-"):-len(".pt")])
+
+class AsyncCheckpointer:
+    """
+    Saves checkpoints without stalling training for the disk write. A save snapshots
+    the state to host memory (into pinned buffers reused across saves, with
+    non-blocking copies from the GPU) and hands it to a background thread, which
+    writes it to a temporary file, fsyncs it and renames it into place, so a
+    checkpoint on disk is always complete. Only the last `keep` checkpoints are kept.
+
+    Training stalls only for the snapshot, and for the previous write if it has not
+    finished by the next save. Both the write and stall times are recorded.
+
+    :param str directory: Checkpoint directory
+    :param int keep: Number of checkpoints kept
+    """
+
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        self._buffers = []
+        self.iteration = None
+        self.write_times = []
+        self.stall_times = []
+
+    def _snapshot(self, obj, buffers):
+        if isinstance(obj, torch.Tensor):
+            idx = len(buffers)
+            buf = self._buffers[idx] if idx < len(self._buffers) else None
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+            buf.copy_(obj.detach(), non_blocking=obj.is_cuda)
+            buffers.append(buf)
+            return buf
+        if isinstance(obj, dict):
+            return type(obj)((key, self._snapshot(value, buffers)) for key, value in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(value, buffers) for value in obj)
+        return obj
+
+    def _write(self, state, name, copied):
+        start = time.perf_counter()
+        if copied is not None:
+            copied.synchronize()
+
+        path = os.path.join(self.directory, name)
+        # unique, as processes emulating nodes on one host share the directory
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        for old_path in sorted(glob.glob(os.path.join(self.directory, "ckpt-*.pt")))[:-self.keep]:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+
+        self.write_times.append(time.perf_counter() - start)
+        logger.info(f"Saved checkpoint {path} in {self.write_times[-1]:.2f} s")
+
+    def wait(self):
+        """
+        Blocks until the pending write, if any, is on disk. A failed write is logged.
+        """
+
+        if self._pending is not None:
+            try:
+                self._pending.result()
+            except Exception:
+                logger.exception("Checkpoint write failed")
+            self._pending = None
+
+    def save(self, state, iteration):
+        """
+        Snapshots the state and writes it in the background, unless a checkpoint of the
+        same iteration was already saved.
+
+        :param dict state: State to save, a nested structure of dictionaries, lists
+            and tensors
+        :param int iteration: Training iteration, which names the checkpoint
+        """
+
+        if iteration == self.iteration:
+            return
+        self.iteration = iteration
+
+        start = time.perf_counter()
+        self.wait()
+
+        buffers = []
+        snapshot = self._snapshot(state, buffers)
+        self._buffers = buffers
+
+        copied = None
+        if torch.cuda.is_available() and any(buf.is_pinned() for buf in buffers):
+            copied = torch.cuda.Event()
+            copied.record()
+
+        self._pending = self._pool.submit(self._write, snapshot, f"ckpt-{iteration:09d}.pt", copied)
+        self.stall_times.append(time.perf_counter() - start)
+
+    def close(self):
+        self.wait()
+        self._pool.shutdown()
+
+    def stats(self):
+        """
+        :return dict: Number of checkpoints written, and their mean write time and
+            mean and max stall time in seconds
+        """
+
+        return {"writes": len(self.write_times),
+                "write_s": sum(self.write_times) / max(1, len(self.write_times)),
+                "stall_s": sum(self.stall_times) / max(1, len(self.stall_times)),
+                "max_stall_s": max(self.stall_times, default=0.0)}
@@ -0,0 +1,228 @@
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+
+import torch
+import torch.distributed as distr
+
+from ignite.engine import Events
+
+"""
+Opt-in profiling of training iterations, split into data-wait and compute phases
+"""
+
+PHASES = ("data", "h2d", "d_step", "g_step", "optim", "allreduce", "checkpoint", "metrics", "other")
+
+
+# Nearest-rank percentile of a list of values, shared with trainer.py
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[max(0, min(len(values) - 1, math.ceil(q / 100 * len(values)) - 1))]
+
+class StepProfiler:
+    """
+    Splits every training iteration into phases:
+
+    - data: waiting for the next batch from the loader (host time)
+    - h2d: copying the batch to the device
+    - d_step, g_step: discriminator and generator forward and backward passes
+    - optim: optimizer steps
+    - allreduce: gradient allreduce, from bucket launch to completion
+    - checkpoint, metrics: checkpoint snapshots and metric syncs in iteration handlers
+    - other: the rest of the iteration, e.g. other handlers and the progress bar
+
+    Phases are timed with CUDA events on GPU, and the device is synchronized once per
+    iteration to read them, which is why profiling is opt-in. Allreduce overlaps the
+    backward passes, so its time is not part of the iteration sum, and the allreduce
+    left exposed at the end of the backward is counted in d_step and g_step. Every
+    other phase adds up to the iteration time.
+
+    :param torch.device device: Device trained on
+    :param int skip: Number of warmup iterations left out of the summary
+    :param bool h2d_in_data: Whether the loader copies batches to the device, so that
+        the copy is counted as data rather than h2d (noted in the summary)
+    """
+
+    def __init__(self, device, skip=10, h2d_in_data=False):
+        self.cuda = device.type == "cuda"
+        self.skip = skip
+        self.h2d_in_data = h2d_in_data
+        self.iterations = 0
+        self.times = {phase: [] for phase in PHASES + ("iteration",)}
+
+        self._pending = []
+        self._lock = threading.Lock()
+        self._iteration_start = None
+        self._batch_start = None
+
+    def _mark(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _add(self, phase, start, end):
+        with self._lock:
+            self._pending.append((phase, start, end))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Times the enclosed code as phase `name`.
+        """
+
+        start = self._mark()
+        yield
+        self._add(name, start, self._mark())
+
+    def timed_hook(self, hook):
+        """
+        Wraps a DDP communication hook to time every bucket it reduces as allreduce.
+
+        :param callable hook: Communication hook
+        :return callable: Timed communication hook
+        """
+
+        def timed(state, bucket):
+            start = self._mark()
+
+            def done(fut):
+                # for CUDA futures, callbacks run on the stream the result is ready on
+                self._add("allreduce", start, self._mark())
+                return fut.value()
+
+            return hook(state, bucket).then(done)
+
+        return timed
+
+    def _batch_started(self, engine):
+        self._iteration_start = self._batch_start = time.perf_counter()
+
+    def _batch_completed(self, engine):
+        now = time.perf_counter()
+        self._add("data", self._batch_start, now)
+
+    def _iteration_completed(self, engine):
+        if self.cuda:
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - self._iteration_start
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        self.iterations += 1
+        if self.iterations <= self.skip:
+            return
+
+        totals = dict.fromkeys(PHASES, 0.0)
+        for phase, start, end in pending:
+            if isinstance(start, float):
+                totals[phase] += (end - start) * 1e3
+            else:
+                totals[phase] += start.elapsed_time(end)
+        totals["other"] = max(0.0, elapsed * 1e3 - sum(total for phase, total in totals.items()
+                                                       if phase not in ("allreduce", "other")))
+        for phase, total in totals.items():
+            self.times[phase].append(total)
+        self.times["iteration"].append(elapsed * 1e3)
+
+    def attach(self, engine):
+        """
+        Iterations end with the last of the ITERATION_COMPLETED handlers registered
+        before the run starts, whatever the order they were added in.
+
+        :param Engine engine: Training engine
+        """
+
+        engine.add_event_handler(Events.GET_BATCH_STARTED, self._batch_started)
+        engine.add_event_handler(Events.GET_BATCH_COMPLETED, self._batch_completed)
+
+        @engine.on(Events.STARTED)
+        def close_iterations(engine):
+            engine.add_event_handler(Events.ITERATION_COMPLETED, self._iteration_completed)
+
+    def summary(self, rank=0):
+        """
+        :param int rank: Rank of this process
+        :return dict: Mean, p50 and p90 time in milliseconds of every phase and of
+            whole iterations, and the share of iteration time of every phase
+        """
+
+        iteration_total = sum(self.times["iteration"]) or float("nan")
+        phases = {}
+        for phase, times in self.times.items():
+            phases[phase] = {"mean_ms": sum(times) / len(times) if times else float("nan"),
+                             "p50_ms": percentile(times, 50),
+                             "p90_ms": percentile(times, 90),
+                             "share": sum(times) / iteration_total}
+        return {"rank": rank, "iterations": len(self.times["iteration"]), "phases": phases,
+                "h2d_in_data": self.h2d_in_data}
+
+# Merge the summaries of every rank
+def merge_summaries(summaries):
+    """
+    Compares the ranks phase by phase. The slowest rank is the one with the highest
+    mean iteration time, and its dominant phase is what it is bound by.
+
+    :param list summaries: Summary of every rank
+    :return tuple: Report (dictionary) and lines of the report table
+    """
+
+    summaries = sorted(summaries, key=lambda summary: summary["rank"])
+    slowest = max(summaries, key=lambda summary: summary["phases"]["iteration"]["mean_ms"])
+    bound_by = max((phase for phase in PHASES if phase != "allreduce"),
+                   key=lambda phase: slowest["phases"][phase]["mean_ms"])
+
+    spread = {}
+    for phase in PHASES + ("iteration",):
+        means = [summary["phases"][phase]["mean_ms"] for summary in summaries]
+        spread[phase] = {"min_ms": min(means), "max_ms": max(means)}
+
+    lines = ["rank  " + " ".join(f"{phase:>10}" for phase in PHASES + ("iteration",)) + "  (mean ms)"]
+    for summary in summaries:
+        row = " ".join(f"{summary['phases'][phase]['mean_ms']:>10.2f}" for phase in PHASES + ("iteration",))
+        lines.append(f"{summary['rank']:>4}  {row}" + ("  <- slowest" if summary is slowest else ""))
+    lines.append(f"Slowest rank {slowest['rank']} is bound by {bound_by} "
+                 f"({slowest['phases'][bound_by]['share'] * 100:.0f}% of iteration time)")
+    if any(summary.get("h2d_in_data") for summary in summaries):
+        lines.append("Batches are copied to the device by the cached loader, so the host-to-device "
+                     "copy is counted in data rather than h2d")
+
+    report = {"slowest_rank": slowest["rank"], "bound_by": bound_by, "spread": spread, "ranks": summaries}
+    return report, lines
+
+# Write the per-rank summary, and the merged report on rank 0
+def write_reports(profiler, directory, logger):
+    """
+    :param StepProfiler profiler: Profiler of this rank
+    :param str directory: Directory where the reports are written
+    :param logging.Logger logger: Logger of the reports
+    """
+
+    distributed = distr.is_available() and distr.is_initialized()
+    rank = distr.get_rank() if distributed else 0
+    summary = profiler.summary(rank)
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f"rank{rank}.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    logger.info(f"Rank {rank} profile over {summary['iterations']} iterations: " +
+                ", ".join(f"{phase} {times['mean_ms']:.2f} ms" for phase, times in summary["phases"].items()))
+
+    summaries = [None] * (distr.get_world_size() if distributed else 1)
+    if distributed:
+        distr.all_gather_object(summaries, summary)
+    else:
+        summaries[0] = summary
+
+    if rank == 0:
+        report, lines = merge_summaries(summaries)
+        with open(os.path.join(directory, "report.json"), "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info("Profile across ranks:\n" + "\n".join(lines))
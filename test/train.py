@@ -1,7 +1,9 @@
 import argparse
+import contextlib
 import os
 import logging
 import shutil
+import sys
 from tqdm import tqdm
 
 import torch
@@ -14,7 +16,6 @@ import torchvision.transforms as transforms
 
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
-from torch.nn.parallel import DistributedDataParallel as DDP
 
 from ignite.contrib.handlers import ProgressBar
 from ignite.contrib.handlers.mlflow_logger import MLflowLogger, OutputHandler
@@ -22,8 +23,11 @@ from ignite.engine import Engine, Events
 from ignite.handlers import Timer
 from ignite.metrics import RunningAverage
 
+from checkpoint import AsyncCheckpointer, checkpoint_iteration, latest_checkpoint
 from nets import DNet, GNet
-from utils import get_CIFAR10_data
+from profiling import StepProfiler, write_reports
+from trainer import GANTrainer
+from utils import MemmapLoader, cache_CIFAR10_data, distribute, get_CIFAR10_data, pin_cpus, serve_data
 
 logger = logging.getLogger("dcgan")
 logger.setLevel(logging.INFO)
@@ -34,51 +38,121 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--data", type=str, default="data/", help="Path to folder where data is stored/downloaded")
     parser.add_argument("-L", "--logs", type=str, default="/tmp/log/", help="Directory where logs are stored")
     parser.add_argument("--n-workers", type=int, default=4, help="Number of workers for dataloader")
+    parser.add_argument("--cache", action="store_true", help="Serve preprocessed data from a memory-mapped cache")
+    parser.add_argument("--data-fanout", action="store_true", help="Fetch data once on the master node and serve it to the other nodes")
+    parser.add_argument("--data-port", type=int, default=29510, help="Port the master node serves data on")
     parser.add_argument("--batch-size", type=int, default=128, help="Batch size for input")
     parser.add_argument("--z-dim", type=int, default=100, help="Latent space dimension")
     parser.add_argument("--n-filter", type=int, default=16, help="Multiplicative factor for filter size")
     parser.add_argument("--epochs", type=int, default=30, help="Number of epochs")
     parser.add_argument("--lr", type=float, default=0.0005, help="Learning rate")
-    parser.add_argument("--local_rank", type=int, default=-1, help="Local rank of process. Needed for torch.distributed.launch")
+    parser.add_argument("--optimized", action="store_true", help="Train with the allocation and sync free GANTrainer")
+    parser.add_argument("--amp", action="store_true", help="Use automatic mixed precision (with --optimized)")
+    parser.add_argument("--channels-last", action="store_true", help="Use channels-last memory format (with --optimized)")
+    parser.add_argument("--compile", action="store_true", help="Compile GNet/DNet with torch.compile (with --optimized)")
+    parser.add_argument("--log-every", type=int, default=10, help="Iterations between loss syncs (with --optimized)")
+    parser.add_argument("--benchmark", type=int, default=0, help="Only time this many optimized training steps")
+    parser.add_argument("--warmup", type=int, default=20, help="Untimed steps before benchmarking")
+    parser.add_argument("--backend", type=str, default="auto", choices=["auto", "nccl", "gloo"], help="Distributed backend. auto uses gloo without CUDA")
+    parser.add_argument("--bucket-cap-mb", type=float, default=25, help="Size of DDP gradient buckets")
+    parser.add_argument("--comm-hook", type=str, default=None, choices=["fp16", "powersgd"], help="Compress gradients allreduced across ranks")
+    parser.add_argument("--powersgd-rank", type=int, default=2, help="Rank of the PowerSGD approximation")
+    parser.add_argument("--powersgd-start", type=int, default=100, help="Iterations of exact allreduce before PowerSGD starts")
+    parser.add_argument("--checkpoint-dir", type=str, default=None, help="Directory where checkpoints are saved and resumed from. Defaults to /var/lib/mars/checkpoints/<cluster>")
+    parser.add_argument("--checkpoint-every", type=int, default=500, help="Save a checkpoint every N iterations (0 disables)")
+    parser.add_argument("--checkpoint-keep", type=int, default=3, help="Number of checkpoints kept")
+    parser.add_argument("--profile", action="store_true", help="Time the data-wait and compute phases of every iteration")
+    parser.add_argument("--profile-dir", type=str, default="profile/", help="Directory where profiles and traces are written")
+    parser.add_argument("--profile-skip", type=int, default=10, help="Warmup iterations left out of the profile")
+    parser.add_argument("--profile-trace", type=int, default=0, help="Record a torch.profiler trace of N iterations")
+    parser.add_argument("--profile-trace-start", type=int, default=50, help="Iteration the trace starts at")
+    parser.add_argument("--local_rank", type=int, default=int(os.environ.get("LOCAL_RANK", -1)),
+                        help="Local rank of process. Needed for torch.distributed.launch")
 
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
 
     # Set distributed flag
     distributed = args.local_rank != -1
+
+    # Pin to the cores the launcher assigned to this local rank
+    cpus = pin_cpus(args.local_rank)
+    if cpus is not None:
+        torch.set_num_threads(len(cpus))
     device = torch.device(f"cuda:{args.local_rank}" if (torch.cuda.is_available() & distributed) else "cpu")
 
     if distributed:
-        logger.info("Starting distributed training...")
-        distr.init_process_group(backend="nccl", init_method="env://")
+        backend = args.backend
+        if backend == "auto":
+            backend = "nccl" if torch.cuda.is_available() else "gloo"
+        logger.info(f"Starting distributed training over {backend}...")
+        if device.type == "cuda":
+            torch.cuda.set_device(device)
+        distr.init_process_group(backend=backend, init_method="env://")
 
     ### DATA
-    # Get CIFAR10 data
-    logger.info("Fetching CIFAR10 data...")
-    dset = get_CIFAR10_data(args.data)
-    
-    # Set (distributed) dataloader
-    dsampler = DistributedSampler(dset) if distributed else None
-    dloader = DataLoader(dataset=dset,
-                         batch_size=args.batch_size,
-                         shuffle=(dsampler is None),
-                         sampler=dsampler,
-                         num_workers=args.n_workers,
-                         pin_memory=True,
-                         drop_last=True)
+    # One process per node stages the data, the other local ranks wait for it. With
+    # fanout, only the master node downloads and the other nodes fetch from it
+    mirror = None
+    if args.data_fanout and distributed:
+        if int(os.environ["RANK"]) == args.local_rank:
+            if args.local_rank == 0:
+                get_CIFAR10_data(args.data)
+                serve_data(os.path.abspath(args.data), args.data_port)
+        else:
+            mirror = f"http://{os.environ['MASTER_ADDR']}:{args.data_port}"
+
+    if args.cache:
+        # Preprocess CIFAR10 once per node, then serve it memory-mapped
+        logger.info("Fetching cached CIFAR10 data...")
+        images, labels = cache_CIFAR10_data(args.data, mirror=mirror)
+
+        dloader = MemmapLoader(images, labels,
+                               batch_size=args.batch_size,
+                               device=device,
+                               mean=(0.5, 0.5, 0.5),
+                               std=(0.5, 0.5, 0.5),
+                               rank=distr.get_rank() if distributed else 0,
+                               world_size=distr.get_world_size() if distributed else 1)
+    else:
+        # Get CIFAR10 data
+        logger.info("Fetching CIFAR10 data...")
+        dset = get_CIFAR10_data(args.data, mirror=mirror)
+
+        # Set (distributed) dataloader
+        dsampler = DistributedSampler(dset) if distributed else None
+        dloader = DataLoader(dataset=dset,
+                             batch_size=args.batch_size,
+                             shuffle=(dsampler is None),
+                             sampler=dsampler,
+                             num_workers=args.n_workers,
+                             pin_memory=True,
+                             drop_last=True)
 
     ### MODEL
     N_CHANNEL = 3
 
     # Set DCGAN model
-    gnet = GNet(z_dim=args.z_dim, n_filter=args.n_filter, n_channel=N_CHANNEL)
-    dnet = DNet(n_filter=args.n_filter, n_channel=N_CHANNEL)
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    gnet = GNet(z_dim=args.z_dim, n_filter=args.n_filter, n_channel=N_CHANNEL).to(device, memory_format=memory_format)
+    dnet = DNet(n_filter=args.n_filter, n_channel=N_CHANNEL).to(device, memory_format=memory_format)
+
+    profiler = None
+    if args.profile and not args.benchmark:
+        profiler = StepProfiler(device, skip=args.profile_skip, h2d_in_data=args.cache)
+
+    # Synchronize gradients across ranks
+    if distributed:
+        gnet = distribute(gnet, device, args.bucket_cap_mb, args.comm_hook, args.powersgd_rank, args.powersgd_start,
+                          profiler=profiler)
+        dnet = distribute(dnet, device, args.bucket_cap_mb, args.comm_hook, args.powersgd_rank, args.powersgd_start,
+                          profiler=profiler)
 
     # Initialize tensorboard
     if os.path.exists(args.logs):
         shutil.rmtree(args.logs)
 
-    if args.local_rank <= 0:
+    if args.local_rank <= 0 and not args.benchmark:
         mlflow_logger = MLflowLogger()
         mlflow_logger.log_params({
             "distributed": distributed,
@@ -93,41 +167,75 @@ if __name__ == "__main__":
     optimizer_g = torch.optim.Adam(gnet.parameters(), lr=args.lr, betas=(0.1, 0.999))
     optimizer_d = torch.optim.Adam(dnet.parameters(), lr=args.lr, betas=(0.1, 0.999))
 
+    if args.optimized or args.benchmark:
+        trainer = GANTrainer(gnet, dnet, optimizer_g, optimizer_d,
+                             batch_size=args.batch_size,
+                             z_dim=args.z_dim,
+                             device=device,
+                             amp=args.amp,
+                             channels_last=args.channels_last,
+                             compile=args.compile,
+                             profiler=profiler)
+
+    if args.benchmark:
+        # Steady-state throughput of the training step alone, on a synthetic batch
+        imgs = torch.rand(args.batch_size, N_CHANNEL, 64, 64) * 2 - 1
+        results = trainer.benchmark(imgs, steps=args.benchmark, warmup=args.warmup)
+        logger.info(f"{results['images_per_s']:.0f} images/s, step time p50 {results['step_ms_p50']:.2f} ms, "
+                    f"p90 {results['step_ms_p90']:.2f} ms, p99 {results['step_ms_p99']:.2f} ms")
+
+        if distributed:
+            distr.barrier()
+        sys.exit(0)
+
+    def phase(name):
+        return profiler.phase(name) if profiler is not None else contextlib.nullcontext()
+
     def update(engine, batch):
         imgs, _ = batch
-        imgs = imgs.to(device)
+        with phase("h2d"):
+            imgs = imgs.to(device)
 
         # train discriminator
-        optimizer_d.zero_grad()
+        with phase("d_step"):
+            optimizer_d.zero_grad()
 
-        y_real = dnet.forward(imgs)
-        real_labels_d = torch.ones(args.batch_size).to(device)
-        loss_dreal = loss_fn(y_real, real_labels_d)
+            y_real = dnet.forward(imgs)
+            real_labels_d = torch.ones(args.batch_size).to(device)
+            loss_dreal = loss_fn(y_real, real_labels_d)
 
-        z_noise = torch.randn(args.batch_size, args.z_dim, 1, 1).to(device)
-        fake_imgs = gnet.forward(z_noise)
-        y_fake = dnet.forward(fake_imgs.detach())
-        fake_labels_d = torch.zeros(args.batch_size).to(device)
-        loss_dfake = loss_fn(y_fake, fake_labels_d)
+            z_noise = torch.randn(args.batch_size, args.z_dim, 1, 1).to(device)
+            fake_imgs = gnet.forward(z_noise)
+            y_fake = dnet.forward(fake_imgs.detach())
+            fake_labels_d = torch.zeros(args.batch_size).to(device)
+            loss_dfake = loss_fn(y_fake, fake_labels_d)
 
-        loss_d = loss_dreal + loss_dfake
-        loss_d.backward()
-        optimizer_d.step()
+            loss_d = loss_dreal + loss_dfake
+            loss_d.backward()
+        with phase("optim"):
+            optimizer_d.step()
 
-        # train generator
-        optimizer_g.zero_grad()
+        # train generator, without allreducing the discriminator's gradients
+        with phase("g_step"):
+            optimizer_g.zero_grad()
 
-        y_fake_g = dnet.forward(fake_imgs)
-        fake_labels_g = torch.ones(args.batch_size).to(device)
+            with dnet.no_sync() if distributed else contextlib.nullcontext():
+                y_fake_g = dnet.forward(fake_imgs)
+                fake_labels_g = torch.ones(args.batch_size).to(device)
 
-        loss_g = loss_fn(y_fake_g, fake_labels_g)
-        loss_g.backward()
-        optimizer_g.step()
+                loss_g = loss_fn(y_fake_g, fake_labels_g)
+                loss_g.backward()
+        with phase("optim"):
+            optimizer_g.step()
 
         return {"loss_d": loss_d.item(), "loss_g": loss_g.item()}
 
+    def optimized_update(engine, batch):
+        imgs, _ = batch
+        trainer.step(imgs)
+
     logger.info("Constructing training engine...")
-    engine = Engine(update)
+    engine = Engine(optimized_update if args.optimized else update)
     timer = Timer(average=True)
 
     timer.attach(engine,
@@ -136,11 +244,90 @@ if __name__ == "__main__":
                  pause=Events.ITERATION_COMPLETED,
                  step=Events.ITERATION_COMPLETED)
 
+    # Reshuffle every epoch, seeded by the epoch so a resumed run continues the sequence
+    @engine.on(Events.EPOCH_STARTED)
+    def set_data_epoch(engine):
+        if args.cache:
+            dloader.set_epoch(engine.state.epoch - 1)
+        elif dsampler is not None:
+            dsampler.set_epoch(engine.state.epoch - 1)
+
+    ### CHECKPOINTING
+    # Local rank 0 of every node saves the (synchronized) state to the node's disk, so
+    # any node surviving an elastic restart holds a checkpoint. On startup, the rank
+    # with the latest checkpoint across nodes loads it and broadcasts it to the others
+    rank = distr.get_rank() if distributed else 0
+    restart = int(os.environ.get("MARS_RESTART", 0))
+    checkpoint_dir = os.path.abspath(args.checkpoint_dir or
+                                     os.path.join("/var/lib/mars/checkpoints", os.environ.get("MARS_CLUSTER", "local")))
+    checkpointer = None
+    if args.checkpoint_every and args.local_rank <= 0:
+        checkpointer = AsyncCheckpointer(checkpoint_dir, keep=args.checkpoint_keep)
+
+    def training_state():
+        state = {"gnet": getattr(gnet, "module", gnet).state_dict(),
+                 "dnet": getattr(dnet, "module", dnet).state_dict(),
+                 "optimizer_g": optimizer_g.state_dict(),
+                 "optimizer_d": optimizer_d.state_dict(),
+                 "engine": engine.state_dict()}
+        if args.optimized:
+            state["scaler"] = trainer.scaler.state_dict()
+        return state
+
+    if args.checkpoint_every:
+        path = latest_checkpoint(checkpoint_dir) if checkpointer is not None else None
+        iterations = [checkpoint_iteration(path) if path else -1]
+        if distributed:
+            iterations = [None] * distr.get_world_size()
+            distr.all_gather_object(iterations, checkpoint_iteration(path) if path else -1)
+        src = max(range(len(iterations)), key=lambda idx: iterations[idx])
+
+        state = [torch.load(path, map_location="cpu") if rank == src and path else None]
+        if distributed:
+            distr.broadcast_object_list(state, src=src)
+        state = state[0]
+
+        if state is None and restart > 0:
+            logger.error(f"Elastic restart {restart} found no checkpoint in {checkpoint_dir} on any node, "
+                         f"TRAINING STARTS FROM SCRATCH")
+
+        if state is not None:
+            getattr(gnet, "module", gnet).load_state_dict(state["gnet"])
+            getattr(dnet, "module", dnet).load_state_dict(state["dnet"])
+            optimizer_g.load_state_dict(state["optimizer_g"])
+            optimizer_d.load_state_dict(state["optimizer_d"])
+            if args.optimized and "scaler" in state:
+                trainer.scaler.load_state_dict(state["scaler"])
+            engine.load_state_dict(state["engine"])
+            logger.info(f"Resuming from epoch {engine.state.epoch}, iteration {engine.state.iteration}, "
+                        f"checkpointed by rank {src}")
+
+            if engine.state.epoch >= args.epochs:
+                logger.info("Training already complete")
+                sys.exit(0)
+
+    if checkpointer is not None:
+        @engine.on(Events.ITERATION_COMPLETED(every=args.checkpoint_every) | Events.COMPLETED)
+        def save_checkpoint(engine):
+            with phase("checkpoint"):
+                checkpointer.save(training_state(), engine.state.iteration)
+
     ### TRAINING
     # Attach metrics
     metrics = ["loss_d", "loss_g"]
-    RunningAverage(alpha=0.98, output_transform=lambda x: x["loss_d"]).attach(engine, "loss_d")
-    RunningAverage(alpha=0.98, output_transform=lambda x: x["loss_g"]).attach(engine, "loss_g")
+    if args.optimized:
+        # losses stay on the device between logging intervals
+        @engine.on(Events.STARTED)
+        def init_metrics(engine):
+            engine.state.metrics.update({name: float("nan") for name in metrics})
+
+        @engine.on(Events.ITERATION_COMPLETED(every=args.log_every))
+        def sync_metrics(engine):
+            with phase("metrics"):
+                engine.state.metrics.update(trainer.pop_metrics())
+    else:
+        RunningAverage(alpha=0.98, output_transform=lambda x: x["loss_d"]).attach(engine, "loss_d")
+        RunningAverage(alpha=0.98, output_transform=lambda x: x["loss_g"]).attach(engine, "loss_g")
 
     if args.local_rank <= 0:
         pbar = ProgressBar()
@@ -161,9 +348,40 @@ if __name__ == "__main__":
                 "Epoch {} finished: Batch average time is {:.3f}".format(engine.state.epoch, timer.value()))
             timer.reset()
 
+    ### PROFILING
+    # Handlers above are timed in the checkpoint and metrics phases, or as other
+    if profiler is not None:
+        profiler.attach(engine)
+
+    trace = contextlib.nullcontext()
+    if args.profile_trace:
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if device.type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        trace = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=max(0, args.profile_trace_start - 1), warmup=1,
+                                             active=args.profile_trace, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(args.profile_dir,
+                                                                     worker_name=f"rank{rank}"))
+
+        @engine.on(Events.ITERATION_COMPLETED)
+        def step_trace(engine):
+            trace.step()
+
     # Initiate training
     logger.info("Starting training!")
-    engine.run(dloader, args.epochs)
+    with trace:
+        engine.run(dloader, args.epochs)
+
+    if checkpointer is not None:
+        checkpointer.close()
+        stats = checkpointer.stats()
+        logger.info(f"Wrote {stats['writes']} checkpoints, mean write time {stats['write_s']:.2f} s, "
+                    f"stall time mean {stats['stall_s'] * 1e3:.1f} ms, max {stats['max_stall_s'] * 1e3:.1f} ms")
+
+    if profiler is not None:
+        write_reports(profiler, args.profile_dir, logger)
 
     logger.info("Training complete!")
 
@@ -1,19 +1,106 @@
+import fcntl
+import http.server
 import os
+import threading
+import time
+import urllib.error
+from contextlib import contextmanager
+from functools import partial
 
+import numpy as np
+import torch
 import torchvision.datasets as datasets
 import torchvision.transforms as transforms
 
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torchvision.datasets.utils import download_and_extract_archive
 
-def get_CIFAR10_data(path):
+
+@contextmanager
+def node_lock(path):
+    """
+    Exclusive lock on a directory, shared by every process on the node (the directory
+    must be on a node-local file system).
+
+    :param str path: Directory to lock
+    """
+
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, ".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def stage(path, name, fetch):
+    """
+    Runs fetch once per node: processes serialize on a lock in path, and those that
+    follow the first find its marker file and return as soon as it is done.
+
+    :param str path: Node-local directory the data is staged in
+    :param str name: Name of the staged data
+    :param callable fetch: Stages the data into path
+    """
+
+    marker = os.path.join(path, f".{name}.staged")
+    with node_lock(path):
+        if not os.path.exists(marker):
+            fetch()
+            open(marker, "w").close()
+
+def fetch_CIFAR10(path, mirror=None, timeout=600):
+    """
+    Downloads and extracts the CIFAR10 archive, from the node serving it (see
+    serve_data) when a mirror is given, else from its origin.
+
+    :param str path: Path to download the data to
+    :param str mirror: URL of the directory the archive is served from
+    :param float timeout: Seconds to wait for the mirror to come up
+    """
+
+    if mirror is None:
+        datasets.CIFAR10(root=path, download=True)
+        return
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            download_and_extract_archive(f"{mirror}/{datasets.CIFAR10.filename}", path,
+                                         md5=datasets.CIFAR10.tgz_md5)
+            return
+        except (urllib.error.URLError, ConnectionError):
+            if time.time() > deadline:
+                raise
+            time.sleep(2)
+
+def serve_data(path, port):
+    """
+    Serves a staged data directory over HTTP from a background thread, so other nodes
+    can fetch it over the private subnet instead of from the internet.
+
+    :param str path: Directory to serve
+    :param int port: Port to serve on
+    :return http.server.ThreadingHTTPServer: Server
+    """
+
+    handler = partial(http.server.SimpleHTTPRequestHandler, directory=path)
+    server = http.server.ThreadingHTTPServer(("0.0.0.0", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def get_CIFAR10_data(path, mirror=None):
     """
     :param str path: Path to download the data to
+    :param str mirror: URL of a node serving the data (see fetch_CIFAR10)
     """
 
-    if not os.path.exists(path):
-        os.makedirs(path)
+    path = os.path.abspath(path)
+    stage(path, "cifar10", partial(fetch_CIFAR10, path, mirror))
 
     dset = datasets.CIFAR10(root=path,
-                            download=True,
+                            download=False,
                             transform=transforms.Compose([
                                 transforms.Resize(64),
                                 transforms.CenterCrop(64),
@@ -23,6 +110,216 @@ def get_CIFAR10_data(path):
         
     return dset
 
+def cache_CIFAR10_data(path, size=64, seed=0, mirror=None):
+    """
+    Preprocesses CIFAR10 once per node, resized and center-cropped as in
+    get_CIFAR10_data, into a uint8 array of shape (N, 3, size, size) stored in a fixed
+    random order. The cache is returned memory-mapped, so every local rank shares the
+    same pages.
+
+    :param str path: Path to download the data to and store the cache in
+    :param int size: Side of the square images
+    :param int seed: Seed of the order the images are stored in
+    :param str mirror: URL of a node serving the data (see fetch_CIFAR10)
+    :return tuple: Memory-mapped images and labels
+    """
+
+    path = os.path.abspath(path)
+    images_path = os.path.join(path, f"cifar10_{size}.npy")
+    labels_path = os.path.join(path, f"cifar10_{size}_labels.npy")
+    stage(path, "cifar10", partial(fetch_CIFAR10, path, mirror))
+
+    def build():
+        dset = datasets.CIFAR10(root=path,
+                                download=False,
+                                transform=transforms.Compose([
+                                    transforms.Resize(size),
+                                    transforms.CenterCrop(size)
+                                ]))
+
+        # write under a temporary name, so a complete images file marks a complete cache
+        tmp_path = f"{images_path}.tmp"
+        images = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(len(dset), 3, size, size))
+        labels = np.empty(len(dset), dtype=np.int64)
+        for dst, src in enumerate(np.random.RandomState(seed).permutation(len(dset))):
+            img, label = dset[src]
+            images[dst] = np.asarray(img, dtype=np.uint8).transpose(2, 0, 1)
+            labels[dst] = label
+        images.flush()
+        del images
+
+        np.save(labels_path, labels)
+        os.replace(tmp_path, images_path)
+
+    if not os.path.exists(images_path):
+        stage(path, f"cifar10_{size}", build)
+
+    # copy-on-write, so batches can be wrapped as (writable) tensors without a copy
+    return np.load(images_path, mmap_mode="c"), np.load(labels_path)
+
+class MemmapLoader:
+    """
+    Serves batches of a memory-mapped uint8 image array, which was shuffled once when
+    cached. Each epoch shifts the batch boundaries by a random offset, cuts the array
+    into windows of `shuffle_window` batches, and visits the windows in a new order
+    with their samples reshuffled, so batches mix different samples every epoch while
+    reads stay within a window. Without shuffling, batches are zero-copy slices.
+    Batches are moved to the device as uint8 and normalized there in a single fused op.
+
+    The shuffle is seeded by the epoch, which set_epoch restores when resuming.
+
+    :param np.ndarray images: uint8 images of shape (N, C, H, W)
+    :param np.ndarray labels: Labels of the images
+    :param int batch_size: Batch size
+    :param torch.device device: Device batches are served on
+    :param tuple mean: Per-channel mean, on the [0, 1] scale of ToTensor
+    :param tuple std: Per-channel standard deviation, on the [0, 1] scale of ToTensor
+    :param bool shuffle: Reshuffle the batches every epoch
+    :param int rank: Rank of the process. Each rank gets a disjoint share of the batches
+    :param int world_size: Number of processes
+    :param int seed: Seed of the shuffle, which must match across ranks
+    :param int shuffle_window: Number of consecutive batches whose samples are
+        reshuffled together
+    """
+
+    def __init__(self, images, labels, batch_size, device, mean, std, shuffle=True, rank=0, world_size=1, seed=0,
+                 shuffle_window=16):
+        self.images = images
+        self.labels = torch.from_numpy(np.ascontiguousarray(labels))
+        self.batch_size = batch_size
+        self.device = device
+        self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.shuffle_window = max(1, shuffle_window)
+        self.epoch = 0
+
+        # leave room for the random offset of the batch boundaries
+        self.n_batches = (len(images) - (batch_size - 1 if shuffle else 0)) // batch_size
+
+        # x/255 normalized by mean and std, as scale * x + bias
+        mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        self.scale = (1 / (255 * std)).to(device)
+        self.bias = (-mean / std).to(device)
+
+    def __len__(self):
+        return self.n_batches // self.world_size
+
+    def set_epoch(self, epoch):
+        """
+        :param int epoch: Epoch (from 0) the next iteration over the loader shuffles for
+        """
+
+        self.epoch = epoch
+
+    def _order(self, rng):
+        n_samples = self.n_batches * self.batch_size
+        window = self.batch_size * self.shuffle_window
+        starts = rng.permutation(np.arange(0, n_samples, window))
+        order = np.concatenate([start + rng.permutation(min(window, n_samples - start)) for start in starts])
+        return rng.randint(self.batch_size) + order.reshape(self.n_batches, self.batch_size)
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+
+        if not self.shuffle:
+            for idx in range(self.rank, self.n_batches, self.world_size)[:len(self)]:
+                start = idx * self.batch_size
+                imgs = torch.from_numpy(self.images[start:start + self.batch_size]).to(self.device, non_blocking=True)
+                labels = self.labels[start:start + self.batch_size].to(self.device, non_blocking=True)
+                yield torch.addcmul(self.bias, imgs.float(), self.scale), labels
+            return
+
+        for batch in self._order(rng)[self.rank::self.world_size][:len(self)]:
+            # sorted, so the gather reads the window front to back
+            batch = np.sort(batch)
+            imgs = torch.from_numpy(self.images[batch]).to(self.device, non_blocking=True)
+            labels = self.labels[torch.from_numpy(batch)].to(self.device, non_blocking=True)
+            yield torch.addcmul(self.bias, imgs.float(), self.scale), labels
+
+def benchmark_loader(loader, n_batches, device):
+    """
+    Measures how many images per second a data loader delivers to the device.
+
+    :param loader: Iterable of (images, labels) batches
+    :param int n_batches: Number of batches to time, after one warmup batch
+    :param torch.device device: Device the batches are used on
+    :return float: Images per second
+    """
+
+    batches = iter(loader)
+    next(batches)
+
+    n_images = 0
+    start = time.perf_counter()
+    for _ in range(n_batches):
+        imgs, _ = next(batches)
+        imgs = imgs.to(device, non_blocking=True)
+        n_images += imgs.shape[0]
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return n_images / (time.perf_counter() - start)
+
+
+def pin_cpus(local_rank):
+    """
+    Pins the current process to the cores assigned to its local rank by the launcher,
+    which exports them as MARS_CPU_BINDING="<CPU ids of rank 0>;<CPU ids of rank 1>;...",
+    each a comma-separated list of CPU ids.
+
+    :param int local_rank: Local rank of process on the node
+    :return list: CPU ids the process is pinned to, or None if no binding was given
+    """
+
+    binding = os.environ.get("MARS_CPU_BINDING")
+    if not binding or local_rank < 0 or not hasattr(os, "sched_setaffinity"):
+        return None
+
+    bindings = binding.split(";")
+    cpus = [int(cpu) for cpu in bindings[local_rank % len(bindings)].split(",")]
+
+    os.sched_setaffinity(0, cpus)
+    return cpus
+
+def distribute(model, device, bucket_cap_mb=25, comm_hook=None, powersgd_rank=2, powersgd_start=100, profiler=None):
+    """
+    Wraps a model in DistributedDataParallel, optionally compressing the gradients it
+    allreduces: "fp16" halves their size, and "powersgd" sends a low-rank approximation
+    (with error feedback) once past the first `powersgd_start` iterations of exact
+    allreduce.
+
+    :param nn.Module model: Model, already on its device
+    :param torch.device device: Device of the model
+    :param float bucket_cap_mb: Size of the gradient buckets allreduced together
+    :param str comm_hook: Gradient compression: None, "fp16" or "powersgd"
+    :param int powersgd_rank: Rank of the PowerSGD approximation
+    :param int powersgd_start: Iterations of exact allreduce before PowerSGD starts
+    :param StepProfiler profiler: Profiler timing the allreduce of every bucket
+    :return DDP: Wrapped model
+    """
+
+    model = DDP(model,
+                device_ids=[device.index] if device.type == "cuda" else None,
+                bucket_cap_mb=bucket_cap_mb,
+                gradient_as_bucket_view=True)
+
+    state, hook = None, None
+    if comm_hook == "fp16":
+        hook = default_hooks.fp16_compress_hook
+    elif comm_hook == "powersgd":
+        state = powerSGD_hook.PowerSGDState(process_group=None,
+                                            matrix_approximation_rank=powersgd_rank,
+                                            start_powerSGD_iter=powersgd_start)
+        hook = powerSGD_hook.powerSGD_hook
+    elif comm_hook is not None:
+        raise ValueError(f"Unknown communication hook {comm_hook}")
 
+    if profiler is not None:
+        hook = profiler.timed_hook(hook or default_hooks.allreduce_hook)
+    if hook is not None:
+        model.register_comm_hook(state=state, hook=hook)
 
-    
\ No newline at end of file
+    return model
@@ -0,0 +1,54 @@
+"""
+Makes the launcher modules and the node agent importable from the tests, and stubs
+the terraform CLI
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "scripts")]
+
+
+def tf_output(worker_ids):
+    return {"master_public_ip": {"value": "3.0.0.1"},
+            "master_private_ip": {"value": "10.0.0.1"},
+            "master_instance_id": {"value": "i-master"},
+            "worker_instance_ids": {"value": worker_ids},
+            "worker_instance_public_ips": {"value": [f"3.0.1.{idx}" for idx in range(len(worker_ids))]},
+            "worker_instance_private_ips": {"value": [f"10.0.1.{idx}" for idx in range(len(worker_ids))]}}
+
+class FakeTerraform:
+    """
+    Stub terraform CLI, first on the PATH, whose `output -json` prints the output set
+    with set_output
+    """
+
+    def __init__(self, directory):
+        self.directory = str(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "terraform")
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\necho "$@" >> {path}.calls\n'
+                    f'[ "$1" = output ] && cat {path}.json\ntrue\n')
+        os.chmod(path, 0o755)
+        self.path = path
+
+    def set_output(self, output):
+        with open(f"{self.path}.json", "w") as f:
+            json.dump(output, f)
+
+    def calls(self):
+        if not os.path.isfile(f"{self.path}.calls"):
+            return []
+        with open(f"{self.path}.calls", "r") as f:
+            return [line.split() for line in f]
+
+@pytest.fixture
+def terraform(tmp_path, monkeypatch):
+    fake = FakeTerraform(tmp_path / "bin")
+    monkeypatch.setenv("PATH", f"{fake.directory}{os.pathsep}{os.environ['PATH']}")
+    return fake
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+Stand-in for the docker CLI, covering the commands the node agent runs. Its images and
+containers live in the JSON file named by $FAKE_DOCKER_STATE, and every call is
+appended to <state>.calls, one JSON list of arguments per line. Images listed under
+"missing" in the state can't be pulled, containers of images listed under "broken"
+fail to run, and logins fail if "deny_login" is set.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import sys
+
+SPEC_LABEL = "mars.spec"
+
+# docker run options taking a value
+RUN_OPTIONS = {"--network", "--name", "--label", "-e", "--gpus", "--cpuset-cpus", "--cpuset-mems",
+               "--memory", "--shm-size", "-v", "-p"}
+
+
+def run(state, args):
+    cmd, args = args[0], args[1:]
+    images, containers = state.setdefault("images", {}), state.setdefault("containers", {})
+
+    if cmd == "image" and args[0] == "inspect":
+        if args[-1] not in images:
+            return 1
+        print(images[args[-1]])
+    elif cmd == "pull":
+        image = args[-1]
+        if image in state.get("missing", []):
+            return 1
+        images.setdefault(image, "sha256:" + hashlib.sha256(image.encode()).hexdigest())
+    elif cmd == "tag":
+        images[args[1]] = images[args[0]]
+    elif cmd == "inspect":
+        container = containers.get(args[-1])
+        if container is None:
+            return 1
+        running = str(container["running"]).lower()
+        if SPEC_LABEL in args[1]:
+            print(container["labels"].get(SPEC_LABEL, "<no value>"), running)
+        else:
+            print(running)
+    elif cmd == "run":
+        container = {"labels": {}, "running": True, "options": []}
+        idx = 1  # past -d
+        while args[idx].startswith("-"):
+            option, value = args[idx], args[idx + 1] if args[idx] in RUN_OPTIONS else None
+            if option == "--name":
+                name = value
+            elif option == "--label":
+                key, _, label = value.partition("=")
+                container["labels"][key] = label
+            else:
+                container["options"].append(option)
+            idx += 1 if value is None else 2
+        container["image"], container["command"] = args[idx], args[idx + 1:]
+        if container["image"] in state.get("broken", []):
+            print(f"docker: Error response from daemon: cannot start {container['image']}", file=sys.stderr)
+            return 125
+        containers[name] = container
+    elif cmd == "start":
+        containers[args[0]]["running"] = True
+    elif cmd == "rm":
+        if containers.pop(args[-1], None) is None:
+            return 1
+    elif cmd == "ps":
+        label = args[args.index("--filter") + 1][len("label="):]
+        key, _, value = label.partition("=")
+        for name, container in containers.items():
+            if container["labels"].get(key) == value:
+                print(name)
+    elif cmd == "login":
+        sys.stdin.read()
+        return 1 if state.get("deny_login") else 0
+    elif cmd not in ("exec", "info"):
+        return 1
+    return 0
+
+def main():
+    path = os.environ["FAKE_DOCKER_STATE"]
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(f"{path}.calls", "a") as f:
+            f.write(json.dumps(sys.argv[1:]) + "\n")
+
+        state = {}
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                state = json.load(f)
+        code = run(state, sys.argv[1:])
+        with open(path, "w") as f:
+            json.dump(state, f)
+    return code
+
+if __name__ == "__main__":
+    sys.exit(main())
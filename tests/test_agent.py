@@ -0,0 +1,238 @@
+"""
+Node agent, run against a fake docker CLI (see fake_docker.py)
+"""
+
+import base64
+import json
+import os
+import time
+
+import pytest
+
+import agent
+
+
+FAKE_DOCKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_docker.py")
+
+
+class FakeDocker:
+    def __init__(self, path):
+        self.path = str(path)
+        self.executable = FAKE_DOCKER
+
+    @property
+    def state(self):
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    @state.setter
+    def state(self, state):
+        with open(self.path, "w") as f:
+            json.dump(state, f)
+
+    def calls(self, cmd=None):
+        """
+        :param str cmd: Docker command to select, e.g. "run". Defaults to every call
+        :return list: Arguments of the calls made since the last call of calls
+        """
+
+        calls = []
+        if os.path.isfile(f"{self.path}.calls"):
+            with open(f"{self.path}.calls", "r") as f:
+                calls = [json.loads(line) for line in f]
+            os.remove(f"{self.path}.calls")
+        return [args for args in calls if cmd is None or args[0] == cmd]
+
+@pytest.fixture
+def docker(tmp_path, monkeypatch):
+    fake = FakeDocker(tmp_path / "docker.json")
+    fake.state = {}
+    monkeypatch.setenv("FAKE_DOCKER_STATE", fake.path)
+    return fake
+
+
+def test_pull_images_pulls_each_image_once(docker):
+    codes = agent.pull_images(["dask:1", "notebook:1", "dask:1"], docker=docker.executable)
+
+    assert codes == {"dask:1": 0, "notebook:1": 0}
+    assert sorted(args[-1] for args in docker.calls("pull")) == ["dask:1", "notebook:1"]
+
+def test_pull_images_falls_back_from_mirror(docker):
+    docker.state = {"missing": ["master:5000/notebook:1"]}
+    codes = agent.pull_images(["dask:1", "notebook:1"], docker=docker.executable,
+                              resolve=lambda image: [f"master:5000/{image}"])
+
+    assert codes == {"dask:1": 0, "notebook:1": 0}
+    assert sorted(args[-1] for args in docker.calls("pull")) == \
+        ["master:5000/dask:1", "master:5000/notebook:1", "notebook:1"]
+    assert docker.state["images"]["dask:1"] == docker.state["images"]["master:5000/dask:1"]
+
+def test_failed_pull_is_reported(docker):
+    docker.state = {"missing": ["dask:1"]}
+    assert agent.pull_images(["dask:1"], docker=docker.executable) == {"dask:1": 1}
+
+def test_start_order_follows_dependencies():
+    images = [{"name": "worker", "depends_on": ["scheduler"]},
+              {"name": "notebook", "depends_on": ["scheduler", "worker"]},
+              {"name": "scheduler"}]
+    assert [img["name"] for img in agent.start_order(images)] == ["scheduler", "worker", "notebook"]
+
+    with pytest.raises(ValueError):
+        agent.start_order([{"name": "a", "depends_on": ["b"]}, {"name": "b", "depends_on": ["a"]}])
+    with pytest.raises(ValueError):
+        agent.start_order([{"name": "a", "depends_on": ["c"]}])
+
+
+def dask_config(worker_command="dask-worker $MASTER_ADDR:8786"):
+    return {"credentials": {},
+            "env": {"MASTER_ADDR": "10.0.0.1"},
+            "images": [{"name": "worker", "image": "dask:1", "command": worker_command,
+                        "depends_on": ["scheduler"]},
+                       {"name": "scheduler", "image": "dask:1", "command": "dask-scheduler"}]}
+
+def run_init(docker, tmp_path, config):
+    agent.run_docker_cmd(config, docker=docker.executable, aws="false",
+                         ecr_cache=str(tmp_path / "ecr_token.json"))
+    return docker.calls()
+
+def test_rerun_leaves_containers_alone(docker, tmp_path):
+    calls = run_init(docker, tmp_path, dask_config())
+    assert [args[args.index("--name") + 1] for args in calls if args[0] == "run"] == ["scheduler", "worker"]
+    assert docker.state["containers"]["worker"]["command"] == ["dask-worker", "$MASTER_ADDR:8786"]
+
+    calls = run_init(docker, tmp_path, dask_config())
+    assert not [args for args in calls if args[0] in ("run", "rm", "start")]
+
+def test_changed_spec_recreates_only_that_container(docker, tmp_path):
+    run_init(docker, tmp_path, dask_config())
+    calls = run_init(docker, tmp_path, dask_config("dask-worker --nthreads 2 $MASTER_ADDR:8786"))
+
+    assert [args[-1] for args in calls if args[0] == "rm"] == ["worker"]
+    assert [args[args.index("--name") + 1] for args in calls if args[0] == "run"] == ["worker"]
+
+def test_new_image_digest_recreates(docker, tmp_path):
+    spec = agent.container_spec("scheduler", "dask:1", docker=docker.executable)
+    assert agent.reconcile_container(spec, docker=docker.executable) == "created"
+
+    state = docker.state
+    state["images"] = {"dask:1": "sha256:rebuilt"}
+    docker.state = state
+    spec = agent.container_spec("scheduler", "dask:1", docker=docker.executable)
+    assert agent.reconcile_container(spec, docker=docker.executable) == "recreated"
+
+def test_stopped_container_is_restarted(docker):
+    spec = agent.container_spec("scheduler", "dask:1", command=["dask-scheduler"], docker=docker.executable)
+    agent.reconcile_container(spec, docker=docker.executable)
+    state = docker.state
+    state["containers"]["scheduler"]["running"] = False
+    docker.state = state
+
+    assert agent.container_state("scheduler", docker=docker.executable) == (spec["hash"], False)
+    assert agent.reconcile_container(spec, docker=docker.executable) == "restarted"
+    assert docker.state["containers"]["scheduler"]["running"]
+
+def test_unlabeled_container_is_recreated(docker):
+    docker.state = {"containers": {"scheduler": {"labels": {}, "running": True}}}
+
+    assert agent.container_state("scheduler", docker=docker.executable) == ("", True)
+    assert agent.container_state("notebook", docker=docker.executable) is None
+    spec = agent.container_spec("scheduler", "dask:1", docker=docker.executable)
+    assert agent.reconcile_container(spec, docker=docker.executable) == "recreated"
+
+def test_failed_run_is_raised(docker, tmp_path):
+    run_init(docker, tmp_path, dask_config())
+    state = docker.state
+    state["broken"] = ["dask:2"]
+    docker.state = state
+    config = dask_config()
+    config["images"][0]["image"] = "dask:2"
+
+    with pytest.raises(RuntimeError, match="worker: docker: Error response from daemon"):
+        run_init(docker, tmp_path, config)
+    assert "worker" not in docker.state["containers"]
+
+def test_unconfigured_containers_are_pruned(docker, tmp_path):
+    config = dask_config()
+    config["images"].append({"name": "notebook", "image": "notebook:1"})
+    run_init(docker, tmp_path, config)
+
+    calls = run_init(docker, tmp_path, dask_config())
+    assert [args[-1] for args in calls if args[0] == "rm"] == ["notebook"]
+    assert sorted(docker.state["containers"]) == ["scheduler", "worker"]
+
+
+class FakeAWS:
+    """
+    Stub AWS CLI printing an ECR authorization token valid for 12 hours
+    """
+
+    def __init__(self, path):
+        self.executable = str(path)
+        token = {"authorizationData": [{"authorizationToken": base64.b64encode(b"AWS:secret").decode(),
+                                        "expiresAt": time.time() + 12 * 3600,
+                                        "proxyEndpoint": "https://123456789012.dkr.ecr.us-east-1.amazonaws.com"}]}
+        with open(f"{path}.json", "w") as f:
+            json.dump(token, f)
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\necho "$@" >> {path}.calls\ncat {path}.json\n')
+        os.chmod(path, 0o755)
+
+    def calls(self):
+        """
+        :return int: Number of calls so far
+        """
+
+        if not os.path.isfile(f"{self.executable}.calls"):
+            return 0
+        with open(f"{self.executable}.calls", "r") as f:
+            return len(f.readlines())
+
+@pytest.fixture
+def aws(tmp_path):
+    return FakeAWS(tmp_path / "aws")
+
+CREDENTIALS = {"AWS_ACCESS_KEY_ID": "AKIA1", "AWS_DEFAULT_REGION": "us-east-1"}
+
+def test_ecr_token_is_reused_across_runs(docker, aws, tmp_path):
+    cache = str(tmp_path / "ecr_token.json")
+    token = agent.ecr_login(CREDENTIALS, docker=docker.executable, aws=aws.executable, cache_path=cache)
+
+    assert (token["username"], token["password"]) == ("AWS", "secret")
+    assert token["logged_in"]
+    assert aws.calls() == 1
+    assert len(docker.calls("login")) == 1
+    assert os.stat(cache).st_mode & 0o777 == 0o600
+
+    assert agent.ecr_login(CREDENTIALS, docker=docker.executable, aws=aws.executable, cache_path=cache) == token
+    assert aws.calls() == 1
+    assert not docker.calls("login")
+
+def test_ecr_token_is_refreshed_before_expiry(docker, aws, tmp_path):
+    cache = str(tmp_path / "ecr_token.json")
+    agent.ecr_login(CREDENTIALS, docker=docker.executable, aws=aws.executable, cache_path=cache)
+    agent.ecr_login(CREDENTIALS, docker=docker.executable, aws=aws.executable, cache_path=cache, margin=13 * 3600)
+    assert aws.calls() == 2
+
+def test_ecr_token_is_not_shared_across_credentials(docker, aws, tmp_path):
+    cache = str(tmp_path / "ecr_token.json")
+    agent.ecr_login(CREDENTIALS, docker=docker.executable, aws=aws.executable, cache_path=cache)
+    agent.ecr_login(dict(CREDENTIALS, AWS_ACCESS_KEY_ID="AKIA2"), docker=docker.executable, aws=aws.executable,
+                    cache_path=cache)
+    assert aws.calls() == 2
+
+def test_failed_docker_login_is_retried_with_cached_token(docker, aws, tmp_path):
+    cache = str(tmp_path / "ecr_token.json")
+    docker.state = {"deny_login": True}
+    token = agent.ecr_login(CREDENTIALS, docker=docker.executable, aws=aws.executable, cache_path=cache)
+    assert not token["logged_in"]
+
+    docker.state = {}
+    token = agent.ecr_login(CREDENTIALS, docker=docker.executable, aws=aws.executable, cache_path=cache)
+    assert token["logged_in"]
+    assert aws.calls() == 1
+    assert len(docker.calls("login")) == 2
+
+def test_ecr_login_without_token(docker, tmp_path):
+    assert agent.ecr_login(CREDENTIALS, docker=docker.executable, aws="false",
+                           cache_path=str(tmp_path / "ecr_token.json")) is None
+    assert not docker.calls("login")
@@ -0,0 +1,67 @@
+"""
+Benchmark suite, with local processes standing in for nodes
+"""
+
+import math
+import socket
+
+import pytest
+
+import bench
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@pytest.mark.parametrize("size, expected", [("4096", 4096), (4096, 4096), ("64MB", 64 << 20), ("64m", 64 << 20),
+                                            ("1.5G", 3 << 29), ("1.5GiB", 3 << 29), (".5K", 512),
+                                            ("2 TB", 2 << 40), ("10b", 10)])
+def test_parse_size(size, expected):
+    assert bench.parse_size(size) == expected
+
+@pytest.mark.parametrize("size", ["", "MB", "1.5.0G", "64XB", "-1G"])
+def test_parse_size_rejects(size):
+    with pytest.raises(ValueError):
+        bench.parse_size(size)
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 11))
+    assert bench.percentile(values, 50) == 5
+    assert bench.percentile(values, 90) == 9
+    assert bench.percentile(values, 99) == 10
+    assert bench.percentile(values, 0) == 1
+    assert bench.percentile([3.0], 99) == 3.0
+    assert math.isnan(bench.percentile([], 50))
+
+def test_local_suite(tmp_path):
+    lines = []
+    results = bench.run_suite(bench.LocalRunner(2), benchmarks=("net", "disk"), net_size=1 << 20, pings=20,
+                              port=free_port(), disk_path=str(tmp_path), disk_size=4 << 20, log=lines.append)
+
+    assert sorted(results["net"]) == ["0->1", "1->0"]
+    for res in results["net"].values():
+        assert res["bandwidth_gbps"] > 0
+        assert 0 < res["latency_us"] <= res["latency_p99_us"]
+    assert sorted(results["disk"]) == ["0", "1"]
+    for res in results["disk"].values():
+        assert res["write_mb_s"] > 0 and res["read_mb_s"] > 0
+    assert lines
+
+    assert len(bench.summarize(results)) == 4
+    assert not any(worse for *_, worse in bench.compare(results, results))
+
+def test_local_allreduce():
+    pytest.importorskip("torch")
+    results = bench.run_suite(bench.LocalRunner(2), benchmarks=("allreduce",), port=free_port(),
+                              sizes=(1 << 10, 1 << 16), backend="gloo", log=lambda line: None)
+
+    assert {int(size) for size, res in results["allreduce"].items() if "busbw_gb_s" in res} == {1 << 10, 1 << 16}
+
+def test_compare_flags_regressions():
+    baseline = {"net": {"0->1": {"bandwidth_gbps": 10.0, "latency_us": 50.0}}}
+    results = {"net": {"0->1": {"bandwidth_gbps": 8.0, "latency_us": 52.0}}}
+
+    rows = {metric: worse for metric, _, _, _, worse in bench.compare(results, baseline, tolerance=0.1)}
+    assert rows == {"net.0->1.bandwidth_gbps": True, "net.0->1.latency_us": False}
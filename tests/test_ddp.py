@@ -0,0 +1,50 @@
+"""
+DDP training of the GAN with each gradient compression hook, over gloo on two local
+processes
+"""
+
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("ignite")
+
+import torch.distributed as distr
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test"))
+
+from nets import DNet, GNet
+from trainer import GANTrainer
+from utils import distribute
+
+
+def train(rank, init_file, comm_hook, steps):
+    distr.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=2)
+    try:
+        # different initial weights and data on every rank: DDP must broadcast rank 0's
+        # weights and keep the ranks in sync from there
+        torch.manual_seed(rank)
+        device = torch.device("cpu")
+        gnet = distribute(GNet(z_dim=16, n_filter=4, n_channel=3), device, comm_hook=comm_hook,
+                          powersgd_start=2)
+        dnet = distribute(DNet(n_filter=4, n_channel=3), device, comm_hook=comm_hook, powersgd_start=2)
+        trainer = GANTrainer(gnet, dnet, torch.optim.Adam(gnet.parameters(), 1e-3),
+                             torch.optim.Adam(dnet.parameters(), 1e-3), 4, 16, device)
+        for _ in range(steps):
+            trainer.step(torch.randn(4, 3, 64, 64))
+        assert all(torch.isfinite(torch.tensor(loss)) for loss in trainer.pop_metrics().values())
+
+        params = torch.cat([p.detach().flatten() for p in list(gnet.parameters()) + list(dnet.parameters())])
+        gathered = [torch.zeros_like(params) for _ in range(2)]
+        distr.all_gather(gathered, params)
+        assert torch.allclose(gathered[0], gathered[1], atol=1e-5), f"ranks diverged with {comm_hook}"
+    finally:
+        distr.destroy_process_group()
+
+@pytest.mark.parametrize("comm_hook", [None, "fp16", "powersgd"])
+def test_ranks_stay_in_sync(tmp_path, comm_hook):
+    mp.spawn(train, args=(str(tmp_path / "init"), comm_hook, 5), nprocs=2)
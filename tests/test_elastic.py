@@ -0,0 +1,104 @@
+"""
+Node loss: emulated spot reclaims and SSH connections to frozen nodes
+"""
+
+import os
+import signal
+import subprocess as sp
+import sys
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("fabric")
+pytest.importorskip("asyncssh")
+
+from launch import DConnection, ElasticJob, LocalNodes
+
+
+# SSH server accepting any password, whose commands never return
+SSH_SERVER = """
+import asyncio, asyncssh
+
+class Server(asyncssh.SSHServer):
+    def begin_auth(self, username):
+        return True
+
+    def password_auth_supported(self):
+        return True
+
+    def validate_password(self, username, password):
+        return True
+
+async def main():
+    key = asyncssh.generate_private_key("ssh-ed25519")
+    server = await asyncssh.create_server(Server, "127.0.0.1", 0, server_host_keys=[key],
+                                          process_factory=lambda process: asyncio.sleep(3600))
+    print(server.sockets[0].getsockname()[1], flush=True)
+    await asyncio.Future()
+
+asyncio.run(main())
+"""
+
+
+def wait_for(path, timeout=10.0):
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        assert time.time() < deadline, f"{path} never appeared"
+        time.sleep(0.05)
+    time.sleep(0.1)
+
+def test_reclaimed_node_is_replaced(tmp_path):
+    nodes = LocalNodes(2, workdir=str(tmp_path), respawn_delay=0.5)
+    rounds = []
+
+    def make_cmds(members, rdzv, round_):
+        rounds.append(list(members))
+        # the first round runs until a node is reclaimed, the next one succeeds
+        return {node: "sleep 30" if round_ == 0 else "true" for node in members}
+
+    def reclaim():
+        pid_path = tmp_path / "node1.pid"
+        wait_for(pid_path)
+        os.killpg(int(pid_path.read_text()), signal.SIGKILL)
+
+    threading.Thread(target=reclaim, daemon=True).start()
+    job = ElasticJob(nodes, make_cmds, min_nodes=2, max_nodes=2, settle_time=0.1, poll_interval=0.1)
+    codes = job.run()
+
+    assert rounds == [[0, 1], [0, 2]]
+    assert codes == {0: 0, 2: 0}
+    assert job.restarts == 1
+    assert nodes.lost == {1}
+
+@pytest.fixture
+def ssh_server(tmp_path):
+    script = tmp_path / "server.py"
+    script.write_text(SSH_SERVER)
+    server = sp.Popen([sys.executable, str(script)], stdout=sp.PIPE, text=True)
+    server.port = int(server.stdout.readline())
+    yield server
+    server.kill()
+    server.wait()
+
+def connect(port, **kwargs):
+    dconn = DConnection("image", host="127.0.0.1", port=port, user="test",
+                        connect_kwargs={"password": "test", "look_for_keys": False, "allow_agent": False},
+                        keepalive=0.5, max_missed=2, **kwargs)
+    dconn.open()
+    return dconn
+
+def test_stream_detects_frozen_node(ssh_server):
+    dconn = connect(ssh_server.port)
+    threading.Timer(1.0, os.kill, (ssh_server.pid, signal.SIGSTOP)).start()
+
+    start = time.time()
+    with pytest.raises(ConnectionError):
+        dconn.stream("sleep 3600")
+    assert time.time() - start < 10
+
+def test_stream_idle_timeout_on_live_node(ssh_server):
+    dconn = connect(ssh_server.port, idle_timeout=2.0)
+    with pytest.raises(TimeoutError):
+        dconn.stream("sleep 3600")
@@ -0,0 +1,37 @@
+"""
+Cluster inventory, rebuilt from a stubbed terraform
+"""
+
+import os
+
+import inventory
+
+from conftest import tf_output
+
+
+def test_saved_output_rebuilds_inventory(terraform, tmp_path):
+    artifacts = str(tmp_path)
+    terraform.set_output(tf_output(["i-1"]))
+    inventory.save_terraform_output(artifacts, artifacts)
+    assert [node["instance_id"] for node in inventory.load_inventory(artifacts).workers] == ["i-1"]
+
+    terraform.set_output(tf_output(["i-1", "i-2"]))
+    inventory.save_terraform_output(artifacts, artifacts)
+    assert inventory.load_inventory(artifacts).by_host("i-2")["public_ip"] == "3.0.1.1"
+    assert not os.path.exists(os.path.join(artifacts, f"{inventory.TF_OUTPUT_FILE}.tmp"))
+
+def test_local_state_newer_than_output_is_saved_again(terraform, tmp_path):
+    artifacts = str(tmp_path)
+    terraform.set_output(tf_output(["i-1"]))
+    inventory.save_terraform_output(artifacts, artifacts)
+    inventory.load_inventory(artifacts)
+
+    state_path = tmp_path / "terraform.tfstate"
+    state_path.write_text("{}")
+    os.utime(state_path, (os.stat(state_path).st_atime, os.stat(state_path).st_mtime + 10))
+    terraform.set_output(tf_output(["i-2"]))
+
+    assert [node["instance_id"] for node in inventory.load_inventory(artifacts, state_path=state_path).workers] \
+        == ["i-2"]
+    assert [node["instance_id"] for node in inventory.load_inventory(artifacts).workers] == ["i-2"]
+    assert len(terraform.calls()) == 2
@@ -0,0 +1,87 @@
+"""
+Launch commands, the pattern that stops them, and node topology probes
+"""
+
+import json
+import re
+import subprocess as sp
+import sys
+import time
+import types
+
+import pytest
+
+pytest.importorskip("fabric")
+
+from launch import (INSTANCE_ID_PROBE, KILL_PATTERN, TOPOLOGY_PROBE, launcher_for, probe_topology,
+                    pytorch_launch_cmd)
+
+
+@pytest.mark.parametrize("nprocs, launcher", [([2, 2], "torch.distributed.launch"),
+                                              ([4, 2, 2], "torch.distributed.run")])
+def test_kill_pattern_matches_launch_cmds(nprocs, launcher):
+    assert launcher_for(nprocs) == launcher
+    for node_rank, nproc in enumerate(nprocs):
+        cmd = pytorch_launch_cmd(n_nodes=len(nprocs), node_rank=node_rank, n_gpus=nproc,
+                                 training_path="train.py", launcher=launcher_for(nprocs))
+        assert re.search(KILL_PATTERN, cmd)
+
+def test_kill_pattern_finds_either_launcher():
+    # stand-ins whose command lines name the launcher module
+    procs = [sp.Popen([sys.executable, "-c", "import time; time.sleep(60)", "-m", launcher])
+             for launcher in ("torch.distributed.launch", "torch.distributed.run")]
+    try:
+        deadline = time.time() + 5
+        while True:
+            found = sp.run(["pgrep", "-f", KILL_PATTERN], stdout=sp.PIPE, universal_newlines=True).stdout.split()
+            if {str(proc.pid) for proc in procs} <= set(found):
+                break
+            assert time.time() < deadline, f"pgrep -f {KILL_PATTERN} found {found}"
+            time.sleep(0.1)
+    finally:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+
+
+class FakeNode:
+    def __init__(self, host, instance_id):
+        self.host = host
+        self.instance_id = instance_id
+        self.cmds = []
+
+    def run(self, cmd, hide=False):
+        self.cmds.append(cmd)
+        out = self.instance_id if cmd == INSTANCE_ID_PROBE else "gpus=1\ncpus=4\nnuma=0:0-3\n"
+        return types.SimpleNamespace(stdout=out)
+
+class FakePool(dict):
+    def map(self, fn, ranks=None):
+        return {rank: fn(rank, self[rank]) for rank in (self if ranks is None else ranks)}
+
+def test_probe_topology_caches_by_instance(tmp_path):
+    cache_path = str(tmp_path / "topology.json")
+    pool = FakePool({0: FakeNode("3.0.0.1", "i-master"), 1: FakeNode("3.0.1.0", "")})
+    assert probe_topology(pool, cache_path=cache_path)[0]["gpus"] == 1
+    with open(cache_path, "r") as f:
+        assert sorted(json.load(f)) == ["3.0.1.0", "i-master"]
+
+    # a replacement instance behind a recycled IP is probed again
+    pool = FakePool({0: FakeNode("3.0.0.1", "i-master2"), 1: FakeNode("3.0.1.0", "")})
+    probe_topology(pool, cache_path=cache_path)
+    assert TOPOLOGY_PROBE in pool[0].cmds
+    assert TOPOLOGY_PROBE not in pool[1].cmds
+
+def test_probe_topology_of_joining_node(tmp_path):
+    cache_path = str(tmp_path / "topology.json")
+    pool = FakePool({0: FakeNode("3.0.0.1", "i-master"), 1: FakeNode("3.0.1.0", "i-1")})
+    probe_topology(pool, cache_path=cache_path)
+
+    pool[2] = FakeNode("3.0.1.1", "i-2")
+    for node in pool.values():
+        node.cmds.clear()
+    assert list(probe_topology(pool, cache_path=cache_path, ranks=[2])) == [2]
+
+    assert not pool[0].cmds and not pool[1].cmds
+    with open(cache_path, "r") as f:
+        assert sorted(json.load(f)) == ["i-1", "i-2", "i-master"]
@@ -0,0 +1,62 @@
+"""
+mars scale, against stubbed terraform, AWS and ansible
+"""
+
+import os
+
+from conftest import tf_output
+from inventory import save_terraform_output
+from mars import MarsCLI
+
+
+class FakeASG:
+    """
+    Autoscaling group answering MarsCLI._aws: raising its desired capacity brings up a
+    new instance, which terraform reports from then on
+    """
+
+    def __init__(self, terraform, instance_ids):
+        self.terraform = terraform
+        self.instance_ids = list(instance_ids)
+        terraform.set_output(tf_output(self.instance_ids))
+
+    def __call__(self, *args):
+        if args[1] == "describe-auto-scaling-groups":
+            return {"AutoScalingGroups": [{"DesiredCapacity": len(self.instance_ids), "MaxSize": 10,
+                                           "Instances": [{"InstanceId": instance_id, "LifecycleState": "InService"}
+                                                         for instance_id in self.instance_ids]}]}
+        if args[1] == "set-desired-capacity":
+            desired = int(args[-1])
+            self.instance_ids += [f"i-{idx + 1}" for idx in range(len(self.instance_ids), desired)]
+            self.terraform.set_output(tf_output(self.instance_ids))
+        return {}
+
+def cli(root):
+    mars = MarsCLI.__new__(MarsCLI)
+    mars.root = root
+    mars.tf_config = {}
+    mars.command_arg = []
+    mars._inventory = None
+    return mars
+
+def test_scale_up_initializes_the_new_workers(terraform, tmp_path):
+    os.makedirs(tmp_path / "artifacts")
+    os.makedirs(tmp_path / "ansible")
+    ansible = os.path.join(terraform.directory, "ansible-playbook")
+    with open(ansible, "w") as f:
+        f.write(f'#!/bin/sh\necho "$@" > {ansible}.args\n')
+    os.chmod(ansible, 0o755)
+
+    mars = cli(tmp_path)
+    mars._aws = FakeASG(terraform, ["i-1"])
+    save_terraform_output(str(tmp_path / "artifacts"), str(tmp_path))
+    assert [node["instance_id"] for node in mars.cluster.workers] == ["i-1"]
+
+    mars._scale_up("workers", 1, "key.pem", timeout=10)
+
+    assert [node["instance_id"] for node in mars.cluster.workers] == ["i-1", "i-2"]
+    with open(f"{ansible}.args", "r") as f:
+        args = f.read().split()
+    assert args[args.index("--limit") + 1] == mars.cluster.by_host("i-2")["public_ip"]
+    assert mars.cluster.by_host("i-2")["public_ip"] in (tmp_path / "ansible" / "inventory").read_text()
+    assert ["refresh"] in terraform.calls()